@@ -1,6 +1,32 @@
 __version__ = '0.0.1'
 
-from rz.docker import ComposeProject
-from rz.kube import Client
+import sys
+import types
 
-__all__ = ['ComposeProject', 'KubeClient']
\ No newline at end of file
+# ComposeProject and Client drag in docker-compose, pykube and the google
+# api client; only import them once somebody asks for them
+_lazy = {
+    'ComposeProject': 'rz.docker',
+    'Client': 'rz.kube',
+}
+
+__all__ = ['ComposeProject', 'Client']
+
+
+class _LazyModule(types.ModuleType):
+
+    def __getattr__(self, name):
+        if name not in _lazy:
+            raise AttributeError(name)
+
+        module = __import__(_lazy[name], fromlist=[name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# python 2 clears a module's globals once it's collected, keep it around
+_module._original = sys.modules[__name__]
+sys.modules[__name__] = _module
@@ -0,0 +1,297 @@
+import click
+import hashlib
+import json
+import six
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+RZD_VERSION_KEY = 'rzd/revision'
+RZD_HASH_KEY    = 'rzd/content-hash'
+
+MANAGED_BY_LABEL = 'app.kubernetes.io/managed-by'
+INSTANCE_LABEL   = 'app.kubernetes.io/instance'
+MANAGED_BY       = 'rz'
+
+APPLY_WORKERS = 8
+
+SUPPORTED_KINDS = ['Namespace', 'Deployment', 'ReplicationController',
+                   'ReplicaSet', 'Pod', 'Service']
+
+ACTION_CREATED  = 'created'
+ACTION_UPDATED  = 'updated'
+ACTION_SKIPPED  = 'skipped'
+ACTION_DELETED  = 'deleted'
+ACTION_REVERTED = 'reverted'
+ACTION_FAILED   = 'failed'
+ACTION_BLOCKED  = 'blocked'
+
+
+def managed_labels(instance):
+    return {MANAGED_BY_LABEL: MANAGED_BY, INSTANCE_LABEL: instance}
+
+
+def managed_selector(instance=None):
+    """Label selector matching the objects rz manages, optionally only those
+    of one app instance."""
+    selector = '%s=%s' % (MANAGED_BY_LABEL, MANAGED_BY)
+    if instance:
+        selector += ',%s=%s' % (INSTANCE_LABEL, instance)
+    return selector
+
+
+def manifest_scope(objects):
+    """The namespace and app instance every object of a manifest lives in,
+    None for either when the objects disagree."""
+    namespaces, instances = set(), set()
+    for obj in objects:
+        if obj['kind'] != 'Namespace':
+            namespaces.add(obj['metadata'].get('namespace', 'default'))
+        labels = obj['metadata'].get('labels') or {}
+        instances.add(labels.get(INSTANCE_LABEL))
+
+    namespace = namespaces.pop() if len(namespaces) == 1 else None
+    instance = instances.pop() if len(instances) == 1 else None
+    return namespace, instance
+
+
+class ApplyResult(object):
+
+    def __init__(self, _json, action=None, error=None, duration=0):
+        self.kind      = _json['kind']
+        self.name      = _json['metadata']['name']
+        self.namespace = _json['metadata'].get('namespace')
+        self.action    = action
+        self.error     = error
+        self.duration  = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return "<ApplyResult %s/%s: %s>" % (self.kind, self.name, self.action)
+
+
+def _without_rzd_annotations(_json):
+    obj = dict(_json)
+    obj['metadata'] = dict(_json['metadata'])
+    annotations = dict(obj['metadata'].get('annotations') or {})
+    annotations.pop(RZD_VERSION_KEY, None)
+    annotations.pop(RZD_HASH_KEY, None)
+    obj['metadata']['annotations'] = annotations
+    return obj
+
+
+def content_hash(_json):
+    """sha256 of the rendered object, ignoring the annotations rzd adds."""
+    obj = _without_rzd_annotations(_json)
+    encoded = json.dumps(obj, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def apply_object(client, _json, revision, force=False):
+    live_object = client.get_by_name(_json['kind'], _json['metadata']['name'],
+                                     _json['metadata'].get('namespace'))
+    digest = content_hash(_json)
+
+    if live_object and not force:
+        live_annotations = live_object.obj['metadata'].get('annotations') or {}
+        # the annotation survives `kubectl edit` and rollout undos, so the
+        # live fields have to agree with the manifest too
+        if live_annotations.get(RZD_HASH_KEY) == digest and \
+                _matches(_without_rzd_annotations(_json), live_object.obj):
+            click.echo("Unchanged %s: %s" %
+                       (_json['kind'], _json['metadata']['name']))
+            return ACTION_SKIPPED
+
+    annotations = _json['metadata'].get('annotations', {})
+    annotations[RZD_VERSION_KEY] = str(revision)
+    annotations[RZD_HASH_KEY] = digest
+    _json['metadata']['annotations'] = annotations
+    n_object = client.object(_json)
+
+    if live_object:
+        click.echo("Updating %s: %s" % (_json['kind'], n_object.name))
+        n_object.update()
+        return ACTION_UPDATED
+
+    click.echo("Creating %s: %s" %
+               (_json['kind'], _json['metadata']['name']))
+    try:
+        n_object.create()
+        return ACTION_CREATED
+    except Exception:
+        # lookups only see objects carrying rz's labels, objects deployed
+        # before they were added make the create fail. pykube's errors don't
+        # carry the status code, so ask the server whether it's there
+        exc_info = sys.exc_info()
+        if not n_object.exists():
+            six.reraise(*exc_info)
+
+    click.echo("Updating %s: %s" % (_json['kind'], n_object.name))
+    n_object.update()
+    return ACTION_UPDATED
+
+
+def _matches(wanted, actual):
+    """Whether every field set in `wanted` has the same value in `actual`.
+    Fields only the server fills in (defaults, status) don't count, and
+    neither does the apiVersion objects are read back with."""
+
+    if isinstance(wanted, dict):
+        return isinstance(actual, dict) and all(
+            key in actual and _matches(value, actual[key])
+            for key, value in wanted.items() if key != 'apiVersion')
+    if isinstance(wanted, list):
+        return isinstance(actual, list) and len(wanted) == len(actual) and \
+            all(_matches(w, a) for w, a in zip(wanted, actual))
+    return wanted == actual
+
+
+def apply_objects(client, objects, revision, workers=APPLY_WORKERS,
+                  force=False):
+    """Applies `objects` on a pool of `workers` threads. Objects only wait
+    for the Namespace they live in (when it is part of the manifest), everything
+    else goes out concurrently. Objects whose content hash matches the live
+    object are skipped unless `force` is set. Returns an ApplyResult per
+    object."""
+
+    for kind in [o['kind'] for o in objects]:
+        if kind not in SUPPORTED_KINDS:
+            raise ValueError("rzb doesn't handle object of type: %s" % kind)
+
+    namespaces = [o for o in objects if o['kind'] == 'Namespace']
+    others     = [o for o in objects if o['kind'] != 'Namespace']
+
+    def run(_json):
+        started = time.time()
+        try:
+            action = apply_object(client, _json, revision, force)
+            return ApplyResult(_json, action, duration=time.time() - started)
+        except Exception as e:
+            click.secho("Failed to apply %s %s: %s" %
+                        (_json['kind'], _json['metadata']['name'], e), fg='red')
+            return ApplyResult(_json, ACTION_FAILED, error=e,
+                               duration=time.time() - started)
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        results = pool.map(run, namespaces)
+        failed_namespaces = set(r.name for r in results if not r.ok)
+
+        runnable = []
+        for _json in others:
+            namespace = _json['metadata'].get('namespace')
+            if namespace in failed_namespaces:
+                results.append(ApplyResult(
+                    _json, ACTION_BLOCKED,
+                    error=RuntimeError("namespace %s failed" % namespace)))
+            else:
+                runnable.append(_json)
+
+        results.extend(pool.map(run, runnable))
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def teardown_objects(client, workers=APPLY_WORKERS, timeout=None,
+                     foreground=False):
+    """Deletes every Deployment and Service `client` sees, all at once on
+    `workers` threads. Deployments are scaled to zero and deleted once
+    their pods are gone, or with `foreground` deleted right away with
+    foreground cascading, waiting for the deletion to finish. Either way
+    each waits at most `timeout` seconds (kube.TEARDOWN_TIMEOUT by
+    default). Returns an ApplyResult per object."""
+    from rz import kube
+
+    timeout = timeout or kube.TEARDOWN_TIMEOUT
+    deadline = time.time() + timeout
+
+    def delete_deployment(dp):
+        if foreground:
+            click.echo("Deleting deployment %s (foreground)" % dp)
+            dp.delete(propagation='Foreground')
+            gone = dp.wait_until_deleted(deadline)
+        else:
+            gone = dp.reap(max(0, deadline - time.time()))
+            click.echo("Deleting deployment %s" % dp)
+            dp.delete()
+
+        if not gone:
+            raise RuntimeError("pods still terminating after %ds" % timeout)
+
+    def delete_service(svc):
+        click.echo("Deleting service %s" % svc)
+        svc.delete()
+
+    def run(args):
+        delete, obj = args
+        started = time.time()
+        try:
+            delete(obj)
+            return ApplyResult(obj.obj, ACTION_DELETED,
+                               duration=time.time() - started)
+        except Exception as e:
+            click.secho("Failed to delete %s: %s" % (obj, e), fg='red')
+            return ApplyResult(obj.obj, ACTION_FAILED, error=e,
+                               duration=time.time() - started)
+
+    jobs = [(delete_deployment, dp) for dp in client.list('Deployment')] + \
+           [(delete_service, svc) for svc in client.list('Service')]
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        return pool.map(run, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def rollback_deployments(deployments, to_revision=0, workers=APPLY_WORKERS,
+                         timeout=None):
+    """Rolls all `deployments` back to `to_revision` at once on `workers`
+    threads, each waiting at most `timeout` seconds (kube.ROLLBACK_TIMEOUT
+    by default) for its rollout. Returns an ApplyResult per deployment."""
+    from rz import kube
+
+    timeout = timeout or kube.ROLLBACK_TIMEOUT
+
+    def run(dp):
+        started = time.time()
+        try:
+            rolled_back, error = dp.rollback(to_revision, timeout)
+            if not rolled_back:
+                raise RuntimeError(error)
+            click.echo("->> Rolled back %s successfully." % dp)
+            return ApplyResult(dp.obj, ACTION_REVERTED,
+                               duration=time.time() - started)
+        except Exception as e:
+            click.secho("->> Rolling back %s failed: %s" % (dp, e), fg='red')
+            return ApplyResult(dp.obj, ACTION_FAILED, error=e,
+                               duration=time.time() - started)
+
+    pool = ThreadPool(max(1, workers))
+    try:
+        return pool.map(run, deployments)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_summary(results):
+    click.echo("%-24s %-32s %-10s %8s" % ('KIND', 'NAME', 'ACTION', 'TIME'))
+    for r in results:
+        click.echo("%-24s %-32s %-10s %7.2fs" %
+                   (r.kind, r.name, r.action, r.duration))
+        if r.error is not None:
+            click.secho("  -> %s" % r.error, fg='red')
+
+    counts = {}
+    for r in results:
+        counts[r.action] = counts.get(r.action, 0) + 1
+    click.echo(", ".join("%d %s" % (counts[action], action)
+                         for action in sorted(counts)))
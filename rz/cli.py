@@ -1,9 +1,11 @@
 import click
 from ConfigParser import ConfigParser
 from operator import itemgetter
-from rz import ComposeProject, kube
-import yaml, os, sys, time
-import pykube
+from rz import apply, ledger, manifest
+import os, sys, time
+
+# pykube, docker-compose and the google api client are slow to import, so
+# commands import what they need when they run
 
 config_filename = '.rz.ini'
 allow_history   = True
@@ -34,9 +36,28 @@ def get_gcs_config(ensure_keys=[]):
     return result
 
 
+kube_options = {}
+
 @click.group()
-def deployer():
-    pass
+@click.option('--pool-size', type=int,
+              help="max keep-alive connections to the kubernetes api")
+@click.option('--timeout', type=int,
+              help="timeout (in seconds) for kubernetes api requests")
+def deployer(pool_size, timeout):
+    kube_options['pool_size'] = pool_size
+    kube_options['timeout']   = timeout
+
+def kube_client(context=None, min_pool_size=0, namespace=None, instance=None):
+    """Client whose lookups only see objects rz manages, in `namespace` and of
+    app `instance` when given."""
+    from rz import kube
+
+    pool_size = kube_options.get('pool_size') or kube.Client.pool_size
+    return kube.Client(context,
+                       pool_size=max(pool_size, min_pool_size),
+                       timeout=kube_options.get('timeout'),
+                       namespace=namespace,
+                       selector=apply.managed_selector(instance))
 
 @click.group()
 def builder():
@@ -105,7 +126,7 @@ def init(*args, **kvargs):
 @click.option('--out', '-o',
               type=click.Path(),
               default="deploy.yml",
-              help="path to kubernetes configration")
+              help="path to kubernetes configration (.jsonl for JSON lines)")
 @click.option('--namespace', '-n',
               default='default',
               help='kubernetes namespace to use.')
@@ -114,95 +135,365 @@ def init(*args, **kvargs):
               help="Skip image building")
 @click.option('--gce-project-id', help="Google Cloud Project Id")
 @click.option('--gce-zone', help="Google Cloud Zone", default="us-central1-a")
+@click.option('--gcs-part-size', default=32,
+              help="Part size in MB for parallel source uploads to GCS")
+@click.option('--gcs-upload-jobs', default=8,
+              help="Number of parts to upload to GCS concurrently")
 @click.option('--registry', help="URL for docker registry to push")
 @click.option('--username', help="Username for docker registry")
 @click.option('--password', help="Password for docker registry")
-def build(builder, out, namespace, skip, gce_project_id, gce_zone, 
-    registry, username, password, tag):
-
-    config = {}
+@click.option('--tag', default='latest', help="Tag for locally built images")
+@click.option('--jobs', '-j', default=1,
+              help="Number of services to build concurrently")
+@click.option('--keep-going/--fail-fast', default=False,
+              help="Keep building other services after a build fails")
+@click.option('--push-jobs', default=4,
+              help="Number of images to push concurrently")
+@click.option('--deploy', is_flag=True, default=False,
+              help="Deploy each service as soon as its image is pushed "
+                   "(local builder only)")
+@click.option('--context', '-c', default="localkube",
+              help="Kubernetes cluster context to deploy to")
+@click.option('--deploy-jobs', default=4,
+              help="Number of services to deploy concurrently")
+@click.option('--rollout-timeout', type=int,
+              help="Seconds to wait for each service to roll out")
+@click.option('--keep', default=ledger.KEEP_REVISIONS,
+              help="Revisions to keep in the ledger with --deploy, besides "
+                   "the last deployed one (0 keeps all)")
+def build(builder, out, namespace, skip, gce_project_id, gce_zone,
+    gcs_part_size, gcs_upload_jobs, registry, username, password, tag, jobs,
+    keep_going, push_jobs, deploy, context, deploy_jobs, rollout_timeout,
+    keep):
+
+    # google builds all services in one go, there's nothing to pipeline
+    if deploy and builder != 'local':
+        raise click.UsageError("--deploy only works with the local builder")
+
+    config = {'tag': tag}
     if builder == 'google':
         assert gce_project_id
         assert gce_zone
         config["project_id"] = gce_project_id
         config['zone']       = gce_zone
+        config['upload_part_size']   = gcs_part_size * 1024 * 1024
+        config['upload_concurrency'] = gcs_upload_jobs
     
     if builder == 'aws':
         raise NotImplementedError()
 
-    project = ComposeProject(os.getcwd())
-    built_images = project.build_with(builder, config, skip)
+    from rz import docker
+    from rz.registry import Registry
 
     if registry:
-        for image in built_images:
-            project.push_to_registry(registry, username, password, image)
+        config['registry'] = Registry(registry, username, password)
+
+    project = docker.ComposeProject(os.getcwd())
+    if deploy:
+        pipelined(project, config, namespace, skip, out, context, jobs,
+                  push_jobs, deploy_jobs, keep_going, rollout_timeout, keep)
+        return
+
+    results = project.build_with(builder, config, skip, jobs, keep_going)
+
+    if results:
+        docker.print_summary(results)
+    if any(not r.ok for r in results):
+        sys.exit(1)
+
+    built_images = [image for r in results if r.builder == 'local'
+                    for image in r.tags]
+
+    if registry and built_images:
+        pushed = project.push_images(config['registry'], built_images,
+                                     push_jobs)
+        docker.print_push_summary(pushed)
+        if any(not r.ok for r in pushed):
+            sys.exit(1)
 
     parsed_config = project.kube_objects(namespace=namespace)
     project.save_for_k8(out, parsed_config)
     click.echo("kubernetes configuration saved at %s" % out)
 
+def pipelined(project, config, namespace, skip, out, context, jobs,
+              push_jobs, deploy_jobs, keep_going, rollout_timeout, keep):
+    """`rzb build --deploy`: every service goes through build, push and
+    deploy on its own, the whole lot being recorded as one revision."""
+
+    instance = project.project.name
+    client = kube_client(context, min_pool_size=deploy_jobs * 2,
+                         namespace=namespace, instance=instance)
+    history = ledger.Ledger(client.api, namespace, instance, keep=keep)
+    revision = next_revision(client, history.revisions())
+
+    results, objects = project.deploy(
+        config, client, revision, namespace=namespace, skip=skip, jobs=jobs,
+        push_jobs=push_jobs, apply_jobs=deploy_jobs, keep_going=keep_going,
+        rollout_timeout=rollout_timeout)
+    ok = all(r.ok for r in results)
+
+    # when some services failed or never got deployed the revision only
+    # holds part of the app: it's recorded as failed, so rollbacks never
+    # pick it
+    try:
+        history.record(revision, objects, status=ledger.STATUS_DEPLOYED if ok
+                       else ledger.STATUS_FAILED)
+    except Exception as e:
+        click.secho("Couldn't record revision %d: %s" % (revision, e),
+                    fg='yellow')
+    else:
+        prune(history)
+
+    project.save_for_k8(out, objects)
+    click.echo("kubernetes configuration saved at %s" % out)
+
+    if not ok:
+        sys.exit(1)
+
 @deployer.command()
 @click.option('--path', '-p',
               default="gce.yml",
               type=click.Path(exists=True),
               help="path to kubernetes configration")
 def start(path):
-    with open(path, 'r') as fp:
-        k8config = yaml.load_all(fp.read())
-
-    k8client = kube.Client()
-    for k8object in k8config:
+    k8client = kube_client()
+    for k8object in manifest.load(path):
         print "Starting service %s ..." % k8object['metadata']['name']
         k8client.object(k8object).create()
 
     click.echo("DONE !!")
 
 @deployer.command()
-def stop():
-    client = kube.Client()
-    for dp in pykube.Deployment.objects(client.api):
-        dp = kube.get_entity(dp)
-        dp.reap()
+@click.option('--namespace', '-n',
+              help="only stop objects in this namespace")
+@click.option('--instance',
+              help="only stop objects of this app instance (compose project)")
+@click.option('--jobs', '-j',
+              default=apply.APPLY_WORKERS,
+              help='number of objects to delete concurrently.')
+@click.option('--timeout', type=int,
+              help='seconds to wait for pods to terminate (default 300).')
+@click.option('--foreground', is_flag=True, default=False,
+              help='delete with foreground cascading instead of scaling '
+                   'deployments down first.')
+def stop(namespace, instance, jobs, timeout, foreground):
+    client = kube_client(min_pool_size=jobs, namespace=namespace,
+                         instance=instance)
+    results = apply.teardown_objects(client, workers=jobs, timeout=timeout,
+                                     foreground=foreground)
+    apply.print_summary(results)
+
+    if any(not r.ok for r in results):
+        sys.exit(1)
+
+def release(client, history, objects, revision, jobs, force=False,
+            rollout_timeout=None, rollback_of=None, logs=None):
+    """Applies `objects` as `revision`, records them in the ledger and waits
+    for their deployments to roll out, showing the logs of failed pods.
+    Returns whether everything went fine."""
+    from rz import kube
+
+    results = apply.apply_objects(client, objects, revision,
+                                  workers=jobs, force=force)
+    apply.print_summary(results)
+    ok = all(r.ok for r in results)
+
+    try:
+        history.record(revision, objects, rollback_of=rollback_of,
+                       status=ledger.STATUS_APPLIED if ok else
+                       ledger.STATUS_FAILED)
+    except Exception as e:
+        click.secho("Couldn't record revision %d: %s" % (revision, e),
+                    fg='yellow')
+        history = None
+    else:
+        prune(history)
+
+    if not ok:
+        return False
+
+    # the cache may not have caught up with what was just applied yet,
+    # check_rollouts reloads each deployment from the server anyway
+    deployments = [kube.Deployment(client.api, o)
+                   for o in objects if o['kind'] == 'Deployment']
+    rollouts = kube.check_rollouts(
+        deployments, rollout_timeout or kube.ROLLOUT_TIMEOUT)
 
-        click.echo("Deleting deployment %s" % dp)
-        dp.delete()
+    failed_pods = []
+    for pods, status in rollouts:
+        if status is not kube.PHASE_RUNNING:
+            ok = False
+            failed_pods.extend(pods)
+
+    logs = logs or {}
+    kube.print_logs(failed_pods, jobs=jobs,
+                    containers=logs.get('containers'),
+                    tail_lines=logs.get('tail_lines') or kube.LOG_TAIL_LINES,
+                    limit_bytes=logs.get('limit_bytes') or kube.LOG_LIMIT_BYTES,
+                    since_seconds=logs.get('since_seconds'))
+
+    if history is not None:
+        try:
+            history.set_status(revision, ledger.STATUS_DEPLOYED if ok else
+                               ledger.STATUS_FAILED)
+        except Exception as e:
+            click.secho("Couldn't update revision %d: %s" % (revision, e),
+                        fg='yellow')
+
+    return ok
+
+
+def prune(history):
+    try:
+        deleted = history.prune()
+    except Exception as e:
+        click.secho("Couldn't prune the ledger: %s" % e, fg='yellow')
+        return
+    if deleted:
+        click.echo("Pruned revisions %s from the ledger" %
+                   ", ".join(str(number) for number in deleted))
+
+
+def next_revision(client, revisions):
+    if revisions:
+        click.echo("Detected deployed version: %d" % revisions[-1].number)
+        return revisions[-1].number + 1
+
+    # deployed before the ledger existed, only the annotations know
+    legacy = client.get_deplopyment_revisions()
+    if legacy:
+        click.echo("Detected deployed version: %s" % legacy[-1])
+        return int(legacy[-1]) + 1
+    return 0
+
+
+def last_deployed(revisions, before=None):
+    for revision in reversed(revisions):
+        if before is not None and revision.number >= before:
+            continue
+        if revision.status == ledger.STATUS_DEPLOYED:
+            return revision.number
+    return None
+
+
+def roll_back_to(client, history, to_revision, jobs, timeout=None):
+    """Re-applies every object of `to_revision` as a new revision. Without a
+    revision in the ledger to go back to, falls back to kubernetes' own
+    rollback of each deployment to its previous replica set."""
+
+    if to_revision is None:
+        click.secho("No revision to go back to in the ledger, rolling "
+                    "deployments back to their previous version", bold=True)
+        results = apply.rollback_deployments(
+            client.list('Deployment'), 0, workers=jobs, timeout=timeout)
+        apply.print_summary(results)
+        return all(r.ok for r in results)
+
+    click.secho("Rolling back to revision: %d" % to_revision, bold=True)
+    try:
+        objects = history.load(to_revision)
+    except KeyError as e:
+        click.secho("->> %s" % e.args[0], fg='red')
+        return False
+
+    revision = next_revision(client, history.revisions())
+    return release(client, history, objects, revision, jobs,
+                   rollout_timeout=timeout, rollback_of=to_revision)
 
-    for svc in pykube.Service.objects(client.api):
-        click.echo("Deleting service %s" % svc)
-        svc.delete()
 
 @click.option('--context', '-c',
               default="localkube",
               help="kubernetes cluster context to use")
-@click.option('--revision',
-              default=0,
-              help='revision number to rollback.')
+@click.option('--namespace', '-n',
+              help="namespace the app lives in")
+@click.option('--instance',
+              help="app instance (compose project)")
 @deployer.command()
-def rollback(context, revision):
-    client = kube.Client(context)
-    revisions = client.get_deplopyment_revisions()
-
-    if len(revisions) > 0:
-        if len(revisions) > 1:
-            click.echo(
-                "Cluster seems to have multiple revisions: {},\
-                 Aborting deployment.".format(revisions))
-            sys.exit(1)
-        else:
-            click.echo("Detected deployed version: %s" % revisions[0])
+def history(context, namespace, instance):
+    client = kube_client(context, namespace=namespace, instance=instance)
+    revisions = ledger.Ledger(client.api, namespace, instance).revisions()
 
-    to_revision = revisions[0]
-    click.secho("Rolling back to revision: %s" % to_revision, bold=True)
+    click.echo("%-10s %-22s %-10s %8s  %s" %
+               ('REVISION', 'CREATED', 'STATUS', 'OBJECTS', 'NOTE'))
+    for r in revisions:
+        note = 'rollback to %s' % r.rollback_of if r.rollback_of else ''
+        click.echo("%-10d %-22s %-10s %8d  %s" %
+                   (r.number, r.created, r.status, r.objects, note))
 
-    for dp in pykube.Deployment.objects(client.api):
-        dp = kube.get_entity(dp)
-        rolled_back, error = dp.rollback(to_revision)
-        if rolled_back:
-            click.echo("->> Rolled back successfully.")
-        else:
-            click.echo("->> Rolling failed b/c of error: %s" % error)
+@click.option('--context', '-c',
+              default="localkube",
+              help="kubernetes cluster context to use")
+@click.option('--namespace', '-n',
+              help="namespace the app lives in")
+@click.option('--instance',
+              help="app instance (compose project)")
+@click.option('--against', type=int,
+              help="revision to compare with (default: the latest one)")
+@click.argument('revision', type=int)
+@deployer.command()
+def diff(context, namespace, instance, against, revision):
+    client = kube_client(context, namespace=namespace, instance=instance)
+    history = ledger.Ledger(client.api, namespace, instance)
+    if against is None:
+        against = history.latest()
+        if against is None:
+            click.secho("the ledger is empty", fg='red')
             sys.exit(1)
 
+    try:
+        lines = ledger.diff(history.load(revision), history.load(against),
+                            'r%d' % revision, 'r%d' % against)
+    except KeyError as e:
+        click.secho(e.args[0], fg='red')
+        sys.exit(1)
+    for line in lines:
+        if line.startswith('+') and not line.startswith('+++'):
+            click.secho(line, fg='green')
+        elif line.startswith('-') and not line.startswith('---'):
+            click.secho(line, fg='red')
+        else:
+            click.echo(line)
+
+@click.option('--context', '-c',
+              default="localkube",
+              help="kubernetes cluster context to use")
+@click.option('--namespace', '-n',
+              help="namespace the app lives in")
+@click.option('--instance',
+              help="app instance (compose project)")
+@click.option('--jobs', '-j',
+              default=apply.APPLY_WORKERS,
+              help='number of objects to apply concurrently.')
+@click.option('--timeout', type=int,
+              help='seconds to wait for deployments to roll out.')
+@click.option('--keep', default=ledger.KEEP_REVISIONS,
+              help='revisions to keep in the ledger, besides the last '
+                   'deployed one (0 keeps all).')
+@click.option('--revision', 'revision_option', type=int,
+              help='deprecated, pass the revision as an argument.')
+@click.argument('revision', type=int, required=False)
+@deployer.command()
+def rollback(context, namespace, instance, jobs, timeout, keep,
+             revision_option, revision):
+    if revision_option is not None:
+        if revision is not None and revision != revision_option:
+            raise click.UsageError("--revision and REVISION disagree")
+        click.secho("--revision is deprecated, use `rzd rollback %d`" %
+                    revision_option, fg='yellow', err=True)
+        revision = revision_option
+
+    client = kube_client(context, min_pool_size=jobs,
+                         namespace=namespace, instance=instance)
+    history = ledger.Ledger(client.api, namespace, instance, keep=keep)
+
+    if revision is None:
+        revisions = history.revisions()
+        if revisions:
+            revision = last_deployed(revisions, before=revisions[-1].number)
+
+    if not roll_back_to(client, history, revision, jobs, timeout):
+        sys.exit(1)
+
 @click.option('--context', '-c',
               default="localkube",
               help="kubernetes cluster context to use")
@@ -213,84 +504,54 @@ def rollback(context, revision):
 @click.option('--rollback/--no-rollback',
               is_flag=True, default=False,
               help='rollback the deploy if not successful.')
-@click.option('--revision',
-              default=0,
-              help='rollback to revision number (only Deployment is supported).')
+@click.option('--revision', type=int,
+              help='revision to roll back to (default: the last deployed one).')
+@click.option('--jobs', '-j',
+              default=apply.APPLY_WORKERS,
+              help='number of objects to apply concurrently.')
+@click.option('--force', is_flag=True,
+              default=False,
+              help='update objects even if they match the manifest.')
+@click.option('--rollout-timeout', type=int,
+              help='seconds to wait for deployments to roll out.')
+@click.option('--log-lines', type=int,
+              help='lines of log to show per failed container.')
+@click.option('--log-bytes', type=int,
+              help='bytes of log to show at most per failed container.')
+@click.option('--log-since', type=int,
+              help='only show log lines of the last N seconds.')
+@click.option('--log-container', multiple=True,
+              help='only show logs of this container (can be repeated).')
+@click.option('--keep', default=ledger.KEEP_REVISIONS,
+              help='revisions to keep in the ledger, besides the last '
+                   'deployed one (0 keeps all).')
 @deployer.command()
-def deploy(context, path, rollback, revision):
-    with open(path, 'r') as fp:
-        objects = list(yaml.load_all(fp.read()))
-
-    client = kube.Client(context)
-    revisions = client.get_deplopyment_revisions()
-
-    new_revision = 0
-    if len(revisions) > 0:
-        if len(revisions) > 1:
-            click.echo(
-                ("Cluster seems to have multiple deployment revisions: {}, "
-                 "Aborting deployment.").format(revisions))
-            sys.exit(1)
-        else:
-            new_revision = int(revisions[0]) + 1
-            click.echo("Detected deployed version: %s" % revisions[0])
-
-    for kind in [o['kind'] for o in objects]:
-        if kind not in ['Deployment', 'ReplicationController', 'ReplicaSet', 'Pod', 'Service']:
-            raise ValueError("rzb doesn't handle object of type: %s" % kind)
-
-    ordered_objects = [o for o in objects if o['kind'] == 'Pod'] + \
-          [o for o in objects if o['kind'] == 'Deployment'] + \
-          [o for o in objects if o['kind'] == 'ReplicationController'] + \
-          [o for o in objects if o['kind'] == 'ReplicaSet'] + \
-          [o for o in objects if o['kind'] == 'Service']
-
-    [_apply_object(client, o, new_revision) for o in ordered_objects]
-
-    deployement_failed = False
-    time.sleep(2)
-
-    for dp in pykube.Deployment.objects(client.api):
-        dp = kube.get_entity(dp)
-        failed_pods, status = dp.check_status()
-
-        if status is not kube.PHASE_RUNNING:
-            deployement_failed = True
-            for pod in failed_pods:
-                click.secho(pod.logs(), bg='red')
-
-    if deployement_failed and rollback:
-        to_revision = revision
-        click.secho("Rolling back to last revision: %s" % to_revision, bold=True)
-
-        for dp in pykube.Deployment.objects(client.api):
-            dp = kube.get_entity(dp)
-            rolled_back, error = dp.rollback(to_revision)
-            if rolled_back:
-                click.echo("->> Rolled back successfully.")
-            else:
-                click.echo("->> Rolling failed b/c of error: %s" % error)
-                sys.exit(1)
-    else:
+def deploy(context, path, rollback, revision, jobs, force, rollout_timeout,
+           log_lines, log_bytes, log_since, log_container, keep):
+    objects = list(manifest.load(path))
+    namespace, instance = apply.manifest_scope(objects)
+    client = kube_client(context, min_pool_size=jobs,
+                         namespace=namespace, instance=instance)
+    history = ledger.Ledger(client.api, namespace, instance, keep=keep)
+
+    revisions = history.revisions()
+    new_revision = next_revision(client, revisions)
+
+    logs = dict(containers=log_container, tail_lines=log_lines,
+                limit_bytes=log_bytes, since_seconds=log_since)
+    if release(client, history, objects, new_revision, jobs, force=force,
+               rollout_timeout=rollout_timeout, logs=logs):
         click.echo("->> SUCCESS")
+        return
 
-RZD_VERSION_KEY = 'rzd/revision'
+    if not rollback:
+        click.secho("->> FAILED", fg='red')
+        sys.exit(1)
 
-def _apply_object(client, _json, revision):
-    live_object = client.get_by_name(_json['kind'], _json['metadata']['name'])
-
-    annotations = _json['metadata'].get('annotations', {})
-    annotations[RZD_VERSION_KEY] = str(revision)
-    _json['metadata']['annotations'] = annotations
-    n_object = client.object(_json)
-
-    if live_object:
-        click.echo("Updating %s: %s" % (_json['kind'], n_object.name))
-        n_object.update()
-    else:
-        click.echo("Creating %s: %s" %
-                   (_json['kind'], _json['metadata']['name']))
-        n_object.create()
+    if revision is None:
+        revision = last_deployed(revisions)
+    if not roll_back_to(client, history, revision, jobs, rollout_timeout):
+        sys.exit(1)
 
 if __name__ == '__main__':
     deployer()
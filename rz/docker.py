@@ -1,11 +1,15 @@
 import os
 import re
-import sys
-import yaml
-import subprocess
+import time
+import click
+import json
+import hashlib
+import threading
+import six
+from multiprocessing.pool import ThreadPool
 from compose.cli.command import get_project
 from compose.service import build_port_bindings, build_container_ports
-from rz import gce
+from rz import apply, engine, ignore, manifest
 
 
 class ComposeProject:
@@ -24,108 +28,612 @@ class ComposeProject:
         if objects is None:
             objects = self.kube_objects()
 
-        with open(path, 'w') as file:
-            file.write(yaml.safe_dump_all(objects,
-                                          default_flow_style=False,
-                                          allow_unicode=True,
-                                          encoding='utf-8'))
+        manifest.dump(objects, path)
 
-    def push_to_registry(self, server, username, password, image):
-        cmd = ["login", server,
-                "--username=%s" % username or "", 
-                "--password=%s" % password or ""]
+    def push_images(self, registry, images, jobs=4):
+        """Pushes `images` to `registry` (a registry.Registry) on `jobs`
+        threads, logging in only once. Images whose digest the registry
+        already has are skipped. Returns a PushResult per image."""
 
-        _execute_with_docker(cmd)
-        _execute_with_docker(["push", image])
+        docker = engine.default_engine()
+        if not docker.logged_in(registry.server):
+            docker.login(registry.server, registry.username,
+                         registry.password)
 
-    def build_with(self, builder, config, skip=False):
-        built_images = []
+        width, lock = 0, threading.Lock()
+        if images:
+            width = max(len(image) for image in images)
+
+        def push(image):
+            result, started = PushResult(image), time.time()
+            echo = _prefixed(image, width, lock)
+            try:
+                _push_image(docker, registry, image, result, echo)
+            except Exception as e:
+                echo("push failed: %s" % e)
+                result.status, result.error = PUSH_FAILED, e
+
+            result.duration = time.time() - started
+            return result
+
+        pool = ThreadPool(max(1, jobs))
+        try:
+            return pool.map(push, images)
+        finally:
+            pool.close()
+            pool.join()
+
+    def build_with(self, builder, config, skip=False, jobs=1,
+                   keep_going=False):
+        if skip:
+            return []
+
+        if builder not in ['google', 'local']:
+            raise ValueError("unknown builder: %s" % builder)
+
+        groups = self._build_groups()
+        if builder == 'google':
+            results = self._build_on_gcb(config, groups, keep_going)
+        else:
+            def build(group, echo):
+                return self._build_services(config, group, echo)
+
+            results = _run_builds(groups, builder, build, jobs, keep_going)
+
+        for service, result in zip(sum(groups, []), results):
+            if result.ok:
+                service.options.pop('build')
+                service.options['image'] = result.image
+
+        return results
+
+    def deploy(self, config, client, revision, namespace='default', skip=False,
+               jobs=1, push_jobs=4, apply_jobs=4, keep_going=False,
+               rollout_timeout=None):
+        """Builds, pushes and deploys service by service: a service moves on
+        to the next stage as soon as it is done with the previous one, so
+        services whose images are ready roll out while others are still
+        building. Each stage runs at most `jobs`, `push_jobs` and
+        `apply_jobs` services at a time. Only the local builder is
+        supported. Returns a pipeline.PipelineResult per group of services
+        sharing a build, and the objects that were applied."""
+
+        from rz import kube, pipeline
+
+        registry = config.get('registry')
+        docker = engine.default_engine()
+        if registry and not docker.logged_in(registry.server):
+            docker.login(registry.server, registry.username,
+                         registry.password)
+
+        labels = apply.managed_labels(self.project.name)
+        applied, objects_of = [], {}
+        if namespace != 'default':
+            ns_spec = _namespace_object(namespace, labels)
+            results = apply.apply_objects(client, [ns_spec], revision)
+            if not results[0].ok:
+                raise results[0].error
+            applied.append(ns_spec)
+
+        groups = [] if skip else self._build_groups()
+        built = set(s.name for group in groups for s in group)
+        items = groups + [[s] for s in self.project.services
+                          if s.name not in built]
+
+        width, lock = max([len(g[0].name) for g in items] or [0]), \
+            threading.Lock()
+
+        def build_services(services):
+            if skip or 'build' not in services[0].options:
+                return services, [[] for _ in services]
+
+            echo = _prefixed(services[0].name, width, lock)
+            _, tags = self._build_services(config, services, echo)
+            for service, service_tags in zip(services, tags):
+                service.options.pop('build')
+                service.options['image'] = service_tags[0]
+            return services, tags
+
+        def push_services(built):
+            services, tags = built
+            if not registry:
+                return services
+
+            echo = _prefixed(services[0].name, width, lock)
+            for service, service_tags in zip(services, tags):
+                for image in service_tags:
+                    result = PushResult(image)
+                    _push_image(docker, registry, image, result, echo)
+                if service_tags:
+                    service.options['image'] = _remote_name(registry.server,
+                                                            service_tags[0])
+            return services
+
+        def deploy_services(services):
+            objects = sum([_service_objects(self.project, s, namespace, labels)
+                           for s in services], [])
+            objects_of[services[0].name] = objects
+
+            results = apply.apply_objects(client, objects, revision,
+                                          workers=len(objects))
+            failures = [r for r in results if not r.ok]
+            if failures:
+                raise RuntimeError("%s %s: %s" % (
+                    failures[0].kind, failures[0].name, failures[0].error))
+
+            deployments = [kube.Deployment(client.api, o)
+                           for o in objects if o['kind'] == 'Deployment']
+            rollouts = kube.check_rollouts(
+                deployments, rollout_timeout or kube.ROLLOUT_TIMEOUT)
+
+            failed = [(pods, status) for pods, status in rollouts
+                      if status != kube.PHASE_RUNNING]
+            if failed:
+                kube.print_logs(sum([pods for pods, _ in failed], []),
+                                tail_lines=kube.LOG_TAIL_LINES,
+                                limit_bytes=kube.LOG_LIMIT_BYTES)
+                raise RuntimeError("rollout failed")
+
+        stages = [pipeline.Stage('build', build_services, jobs),
+                  pipeline.Stage('push', push_services, push_jobs),
+                  pipeline.Stage('deploy', deploy_services,
+                                 apply_jobs)]
+        results = pipeline.run(items, stages,
+                               names=[", ".join(s.name for s in group)
+                                      for group in items],
+                               keep_going=keep_going)
+        pipeline.print_summary(results, stages)
+
+        for group in items:
+            applied.extend(objects_of.get(group[0].name, []))
+        return results, applied
+
+    def _build_groups(self):
+        services = []
         for service in self.project.services:
-            if not skip:
-                if 'build' in service.options:
-                    if builder == 'google':
-                        project_id, image_uri = config[
-                            'project_id'], service.name
-                        bucket = config.get(
-                            'bucket_name',
-                            "{}-cbstorage".format(config['project_id'])
-                        )
-
-                        gcr_hostname = get_gcr_hostname(config['zone'])
-                        image_uri = "%s/%s/%s" % (gcr_hostname,
-                                                  config['project_id'],
-                                                  service.name)
-                        bucket, archive = gce.archive_codebase(
-                            self.root, project_id, bucket)
-
-                        source_key = gce.upload_to_gcr(
-                            project_id, bucket, archive)
-                        gce.build_from_gcr(
-                            project_id, bucket, source_key,
-                            image_uri, service.options['build'])
-
-                    elif builder == 'local':
-                        image_uri = "%s:%s" % (service.name, config['tag'])
-                        options = service.options['build'].copy()
-                        options['tag'] = image_uri
-                        
-                        build_with_docker(options)
-                        built_images.append(image_uri)
-
-                    else:
-                        raise ValueError("unknown builder: %s" % builder)
-
-                    service.options.pop('build')
-                    service.options['image'] = image_uri
-
-                elif 'image' in service.options:
-                    click.echo("Skipping %s" % service.name)
+            if 'build' in service.options:
+                services.append(service)
+            elif 'image' in service.options:
+                click.echo("Skipping %s" % service.name)
+            else:
+                raise ValueError(
+                    "no image or build value found for service: %s" %
+                    service.name)
+
+        # services sharing a build spec (say web and worker only differing
+        # in their command) are built once and tagged for each of them
+        groups, by_spec = [], {}
+        for service in services:
+            spec = json.dumps(service.options['build'], sort_keys=True)
+            if spec not in by_spec:
+                by_spec[spec] = []
+                groups.append(by_spec[spec])
+            by_spec[spec].append(service)
+
+        return groups
+
+    def _upload_source(self, config):
+        from rz import gce
+
+        project_id = config['project_id']
+        bucket = config.get(
+            'bucket_name',
+            "{}-cbstorage".format(config['project_id'])
+        )
+
+        bucket, archive = gce.archive_codebase(
+            self.root, project_id, bucket, echo=click.echo)
+        try:
+            source_key = gce.upload_to_gcr(
+                project_id, bucket, archive, echo=click.echo,
+                part_size=config.get('upload_part_size',
+                                     gce.UPLOAD_PART_SIZE),
+                concurrency=config.get('upload_concurrency',
+                                       gce.UPLOAD_CONCURRENCY))
+        finally:
+            os.remove(archive.name)
+
+        return bucket, source_key
+
+    def _build_on_gcb(self, config, groups, keep_going=False):
+        """Submits one Cloud Build per group, all at once, and waits for the
+        lot; the run takes as long as the slowest build."""
+
+        from rz import gce
+
+        if not groups:
+            return []
+
+        # the codebase is archived and uploaded once, every build request
+        # then points at the same source object
+        bucket, source_key = self._upload_source(config)
+
+        gcr_hostname = get_gcr_hostname(config['zone'])
+        uris = [["%s/%s/%s" % (gcr_hostname, config['project_id'], s.name)
+                 for s in group] for group in groups]
+
+        builds = gce.run_builds(
+            config['project_id'], bucket, source_key,
+            [(u[0], g[0].options['build'], u[1:])
+             for g, u in zip(groups, uris)],
+            echo=click.echo, fail_fast=not keep_going)
+
+        results = []
+        for group, group_uris, build in zip(groups, uris, builds):
+            for service, image_uri in zip(group, group_uris):
+                result = BuildResult(service.name, 'google', image_uri,
+                                     duration=build.duration)
+                result.digest = build.images.get(image_uri)
+                if build.ok:
+                    result.status = BUILD_OK
+                elif build.status == 'CANCELLED':
+                    result.status = BUILD_CANCELLED
                 else:
-                    raise ValueError(
-                        "no image or build value found for service: %s" %
-                        service.name)
-        return built_images
+                    result.status = BUILD_FAILED
+                    result.error = RuntimeError(
+                        'Build returned %s - check build ID %s' %
+                        (build.status, build.id))
+                results.append(result)
+
+        return results
+
+    def _build_services(self, config, services, echo):
+        if len(services) > 1:
+            echo("Building once for %s" %
+                 ", ".join(s.name for s in services))
+
+        image_uris = ["%s:%s" % (service.name, config['tag'])
+                      for service in services]
+        options = services[0].options['build'].copy()
+        options['tag'] = image_uris[0]
+
+        return build_cached(options, config.get('registry'), echo=echo,
+                            aliases=image_uris[1:])
+
+
+BUILD_OK        = 'ok'
+BUILD_CACHED    = 'cached'
+BUILD_FAILED    = 'failed'
+BUILD_CANCELLED = 'cancelled'
+
+
+class BuildResult(object):
+
+    def __init__(self, service, builder, image=None, status=None, error=None,
+                 duration=0):
+        self.service  = service
+        self.builder  = builder
+        self.image    = image
+        self.tags     = [image] if image else []
+        self.digest   = None
+        self.status   = status
+        self.error    = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.status in [BUILD_OK, BUILD_CACHED]
+
+    def __repr__(self):
+        return "<BuildResult %s: %s>" % (self.service, self.status)
+
+
+PUSH_OK      = 'pushed'
+PUSH_SKIPPED = 'skipped'
+PUSH_FAILED  = 'failed'
+
+
+class PushResult(object):
+
+    def __init__(self, image, status=None, digest=None, size=0, error=None,
+                 duration=0):
+        self.image    = image
+        self.status   = status
+        self.digest   = digest
+        self.size     = size
+        self.error    = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.status in [PUSH_OK, PUSH_SKIPPED]
+
+    def __repr__(self):
+        return "<PushResult %s: %s>" % (self.image, self.status)
+
+
+def _push_image(docker, registry, image, result, echo):
+    remote_image = _remote_name(registry.server, image)
+    if remote_image != image:
+        docker.tag(image, remote_image)
+
+    repository, tag = remote_image[len(registry.server) + 1:].rsplit(':', 1)
+    remote_digest = registry.manifest_digest(repository, tag)
+
+    if remote_digest:
+        local_digests = docker.inspect(remote_image).get('RepoDigests') or []
+        if "%s@%s" % (remote_image.rsplit(':', 1)[0],
+                      remote_digest) in local_digests:
+            echo("%s is up to date" % remote_image)
+            result.status, result.digest = PUSH_SKIPPED, remote_digest
+            return
+
+    pushed = docker.push(remote_image, echo=echo)
+    result.status = PUSH_OK
+    result.digest = pushed.get('Digest')
+    result.size   = pushed.get('Uploaded', 0)
+
+
+def _prefixed(name, width, lock):
+    def echo(message):
+        if isinstance(message, bytes):
+            message = message.decode('utf-8', 'replace')
+        with lock:
+            for line in six.text_type(message).splitlines() or [u'']:
+                click.echo(u"%s | %s" % (name.ljust(width), line))
+    return echo
+
+
+def _run_builds(groups, builder, build, jobs=1, keep_going=False):
+    """Runs `build(services, echo)` for every group of services sharing a
+    build on `jobs` threads, output prefixed with the name of the group's
+    first service. `build` returns the build status and, for each service,
+    the image tags it produced, the first one being the service's image.
+    Unless `keep_going` is set, the first failure cancels the builds that
+    haven't started yet. Returns a BuildResult per service."""
+
+    width, lock, failed = 0, threading.Lock(), threading.Event()
+    if groups:
+        width = max(len(g[0].name) for g in groups)
+
+    def run(services):
+        results = [BuildResult(s.name, builder) for s in services]
+        if failed.is_set() and not keep_going:
+            for result in results:
+                result.status = BUILD_CANCELLED
+            return results
+
+        started = time.time()
+        echo = _prefixed(services[0].name, width, lock)
+        try:
+            status, tags = build(services, echo)
+            for result, service_tags in zip(results, tags):
+                result.status, result.tags = status, service_tags
+                result.image = service_tags[0]
+        except Exception as e:
+            echo("build failed: %s" % e)
+            for result in results:
+                result.status, result.error = BUILD_FAILED, e
+            failed.set()
+
+        for result in results:
+            result.duration = time.time() - started
+        return results
+
+    pool = ThreadPool(max(1, jobs))
+    try:
+        return sum(pool.map(run, groups), [])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def print_summary(results):
+    click.echo("%-32s %-10s %8s  %s" % ('SERVICE', 'STATUS', 'TIME', 'IMAGE'))
+    for r in results:
+        image = r.image or ''
+        if r.digest:
+            image = "%s@%s" % (image, r.digest)
+        click.echo("%-32s %-10s %7.2fs  %s" %
+                   (r.service, r.status, r.duration, image))
+        if r.error is not None:
+            click.secho("  -> %s" % r.error, fg='red')
+
+
+def print_push_summary(results):
+    click.echo("%-48s %-8s %8s %12s  %s" %
+               ('IMAGE', 'STATUS', 'TIME', 'UPLOADED', 'DIGEST'))
+    for r in results:
+        click.echo("%-48s %-8s %7.2fs %12s  %s" %
+                   (r.image, r.status, r.duration, _human_size(r.size),
+                    r.digest or ''))
+        if r.error is not None:
+            click.secho("  -> %s" % r.error, fg='red')
+
+
+def _human_size(size):
+    for unit in ['B', 'KB', 'MB']:
+        if size < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024.0
+    return "%.1fGB" % size
+
+
+CACHE_TAG_PREFIX = 'rz-'
+CACHE_DIGEST_LENGTH = 24
+
+
+def build_cached(req, registry=None, echo=None, aliases=()):
+    """Builds `req` unless an image built from the very same inputs exists
+    already, locally or in `registry` (a registry.Registry). Built images are
+    also tagged by their build digest so later runs can find them, and the
+    result is tagged as every image in `aliases` too. Returns the build
+    status and the list of tags for `req` followed by those of each alias."""
+
+    echo = echo or click.echo
+    docker = engine.default_engine()
+    docker.version()
+
+    build_id = build_digest(req, echo)
+    if build_id is None:
+        echo("Can't resolve the base images of %s, building without the "
+             "cache" % req['tag'])
+        get_image(req, True, echo=echo)
+        for alias in aliases:
+            docker.tag(req['tag'], alias)
+        return BUILD_OK, [[req['tag']]] + [[alias] for alias in aliases]
+
+    repository = req['tag'].rsplit(':', 1)[0]
+    digest_tag = CACHE_TAG_PREFIX + build_id[:CACHE_DIGEST_LENGTH]
+    cache_tag = "%s:%s" % (repository, digest_tag)
+
+    if docker.image_id(cache_tag):
+        echo("Using cached image %s" % cache_tag)
+        docker.tag(cache_tag, req['tag'])
+        status = BUILD_CACHED
+
+    elif registry and registry.has_image(repository, digest_tag):
+        remote_tag = _remote_name(registry.server, cache_tag)
+        echo("Pulling cached image %s" % remote_tag)
+        docker.pull(remote_tag, echo=echo)
+        docker.tag(remote_tag, cache_tag)
+        docker.tag(remote_tag, req['tag'])
+        status = BUILD_CACHED
+
+    else:
+        get_image(req, True, echo=echo)
+        docker.tag(req['tag'], cache_tag)
+        status = BUILD_OK
+
+    tags = [[req['tag'], cache_tag]]
+    for alias in aliases:
+        alias_tags = [alias, "%s:%s" % (alias.rsplit(':', 1)[0], digest_tag)]
+        for tag in alias_tags:
+            docker.tag(req['tag'], tag)
+        tags.append(alias_tags)
+
+    return status, tags
+
+
+def build_digest(req, echo=None):
+    """sha256 over everything `docker build` looks at: the files of the
+    context (minus .dockerignore), the Dockerfile, build args and the ids of
+    the base images. None when a base image can't be resolved."""
+
+    context = req['context']
+    dockerfile = req.get('dockerfile', 'Dockerfile')
+    digest = hashlib.sha256()
+
+    digest.update(('dockerfile:%s\n' % dockerfile).encode('utf-8'))
+    for key, value in sorted(_build_args(req.get('args')).items()):
+        digest.update(('arg:%s=%s\n' % (key, value)).encode('utf-8'))
+
+    docker = engine.default_engine()
+    for image in _base_images(os.path.join(context, dockerfile)):
+        image_id = _base_image_id(docker, image, echo)
+        if image_id is None:
+            return None
+        digest.update(('from:%s@%s\n' % (image, image_id)).encode('utf-8'))
+
+    rules = ignore.IgnoreRules.from_files(context, ['.dockerignore'])
+    for relpath in rules.walk(context):
+        digest.update(('file:%s:%s\n' % (
+            relpath, _file_digest(os.path.join(context, relpath))
+        )).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def _build_args(args):
+    if isinstance(args, dict):
+        return args
+
+    result = {}
+    for arg in args or []:
+        key, _, value = arg.partition('=')
+        result[key] = value
+    return result
+
+
+def _base_images(dockerfile):
+    images, stages = [], set()
+    if not os.path.isfile(dockerfile):
+        return images
+
+    with open(dockerfile) as fp:
+        for line in fp:
+            words = line.split()
+            if not words or words[0].upper() != 'FROM':
+                continue
+
+            words = [w for w in words[1:] if not w.startswith('--')]
+            if words and words[0] not in stages:
+                images.append(words[0])
+            if len(words) == 3 and words[1].upper() == 'AS':
+                stages.add(words[2])
+
+    return images
+
+
+def _base_image_id(docker, image, echo=None):
+    """Id of the base `image`, pulled first if it isn't local yet (the build
+    would pull it anyway), or None if it can't be found."""
+
+    if image == 'scratch' or '@' in image:
+        # no image at all, or pinned by digest already
+        return image
+    if '$' in image:
+        # depends on a build arg, only the build knows
+        return None
+
+    image_id = docker.image_id(image)
+    if image_id is None:
+        try:
+            docker.pull(image, echo=echo)
+        except engine.EngineError as e:
+            if echo:
+                echo("Couldn't pull %s: %s" % (image, e))
+            return None
+        image_id = docker.image_id(image)
+    return image_id
+
+
+def _file_digest(path):
+    if os.path.islink(path):
+        return 'link:%s' % os.readlink(path)
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _remote_name(server, image):
+    server = re.sub(r'^https?://', '', server).rstrip('/')
+    if image.startswith(server + '/'):
+        return image
+    return "%s/%s" % (server, image)
 
 
-def build_with_docker(req, pull_image=True, dry_run=False):
-    _execute_with_docker(["version"])
-    return get_image(req, pull_image, dry_run)
+def build_with_docker(req, pull_image=True, dry_run=False, echo=None):
+    engine.default_engine().version()
+    return get_image(req, pull_image, dry_run, echo)
 
 
-def get_image(req, pull_image, dry_run=False):
+def get_image(req, pull_image, dry_run=False, echo=None):
     found = False
+    docker = engine.default_engine()
 
     assert req
 
     if 'image' not in req and 'pull' in req:
         req['image'] = req['pull']
-
-        for ln in subprocess.check_output(["docker", "images", "--no-trunc", "--all"]).splitlines():
-            try:
-                m = re.match(r"^([^ ]+)\s+([^ ]+)\s+([^ ]+)", ln)
-                sp = req["image"].split(":")
-                if len(sp) == 1:
-                    sp.append("latest")
-                if ((sp[0] == m.group(1) and sp[1] == m.group(2)) or req["image"] == m.group(3)):
-                    found = True
-                    break
-            except ValueError:
-                pass
+        found = docker.image_id(req['image']) is not None
 
     if not found and pull_image:
         if 'image' in req:
-            cmd = ["docker", "pull", req["image"]]
-
             if not dry_run:
-                subprocess.check_call(cmd, stdout=sys.stderr)
+                docker.pull(req['image'], echo=echo)
                 found = True
         elif "context" in req:
             req['dockerfile'] = req.get('dockerfile', 'Dockerfile')
-            cmd = ["docker", "build", "--tag=%s" %
-                   req["tag"], "-f", req['dockerfile'], req['context']]
 
             if not dry_run:
-                subprocess.check_call(cmd, stdout=sys.stderr)
+                docker.build(req['context'], req['tag'],
+                             dockerfile=req['dockerfile'],
+                             buildargs=_build_args(req.get('args')),
+                             echo=echo)
                 found = True
 
     return found
@@ -133,192 +641,195 @@ def get_image(req, pull_image, dry_run=False):
 
 def _parse_docker_compose(project, **kwargs):
     ns_name, kube_objects = kwargs.get('namespace', 'default'), []
-    dp_version = 'extensions/v1beta1'
+    labels = apply.managed_labels(project.name)
 
     if ns_name != 'default':
-        ns_spec = {
-            "apiVersion": "v1",
-            "kind": "Namespace",
-            "metadata": {
-                "name": ns_name
-            }
-        }
-        kube_objects.append(ns_spec)
+        kube_objects.append(_namespace_object(ns_name, labels))
 
     for service in project.services:
-        service_ports = build_container_ports(service.options, service.options)
+        kube_objects.extend(_service_objects(project, service, ns_name, labels))
 
-        dp_spec = {
-            "kind": "Deployment",
-            "apiVersion": dp_version,
-            "metadata": {
-                "name": service.name,
-                "namespace": ns_name
-            },
-            "spec": {
-                "replicas": 1,
-                "strategy": {
-                    "type": "RollingUpdate",
-                    "rollingUpdate": {
-                        "maxUnavailable": 0,
-                        "maxSurge": 1
-                    }
-                },
-                "template": None
-            }
+    return kube_objects
+
+
+def _namespace_object(ns_name, labels):
+    return {
+        "apiVersion": "v1",
+        "kind": "Namespace",
+        "metadata": {
+            "name": ns_name,
+            "labels": dict(labels)
         }
+    }
 
-        exposed_ports = []
-        for port in service_ports:
-            if isinstance(port, basestring):
-                exposed_ports.append(
-                    {"containerPort": int(port), "protocol": "TCP"})
-            elif isinstance(port, (tuple, list)):
-                exposed_ports.append(
-                    {"containerPort": int(port[0]),
-                     "protocol": port[1].upper()})
-            else:
-                raise ValueError("Unexpected value for port: %s" % port)
 
-        pod_spec = {
-            "spec": {
-                "containers": [{
-                    "name": service.name,
-                    "image": service.image_name,
-                    "ports": exposed_ports,
-                    "imagePullPolicy": "IfNotPresent"
-                }]
+def _service_objects(project, service, ns_name, labels):
+    """The Services and the Deployment of one compose service."""
+    kube_objects = []
+    dp_version = 'extensions/v1beta1'
+
+    service_ports = build_container_ports(service.options, service.options)
+
+    dp_spec = {
+        "kind": "Deployment",
+        "apiVersion": dp_version,
+        "metadata": {
+            "name": service.name,
+            "namespace": ns_name,
+            "labels": dict(labels)
+        },
+        "spec": {
+            "replicas": 1,
+            "strategy": {
+                "type": "RollingUpdate",
+                "rollingUpdate": {
+                    "maxUnavailable": 0,
+                    "maxSurge": 1
+                }
             },
-            "metadata": {
+            "template": None
+        }
+    }
+
+    exposed_ports = []
+    for port in service_ports:
+        if isinstance(port, basestring):
+            exposed_ports.append(
+                {"containerPort": int(port), "protocol": "TCP"})
+        elif isinstance(port, (tuple, list)):
+            exposed_ports.append(
+                {"containerPort": int(port[0]),
+                 "protocol": port[1].upper()})
+        else:
+            raise ValueError("Unexpected value for port: %s" % port)
+
+    pod_spec = {
+        "spec": {
+            "containers": [{
                 "name": service.name,
-                "namespace": ns_name,
-                "labels": {
-                    "app": service.name
-                }
+                "image": service.image_name,
+                "ports": exposed_ports,
+                "imagePullPolicy": "IfNotPresent"
+            }]
+        },
+        "metadata": {
+            "name": service.name,
+            "namespace": ns_name,
+            "labels": {
+                "app": service.name
             }
         }
+    }
 
-        service_volumes = service.options.get('volumes', [])[:]
+    service_volumes = service.options.get('volumes', [])[:]
 
-        if service.volumes_from:
-            for external_volume in service.volumes_from:
-                for vol_spec in external_volume.source.options['volumes']:
-                    service_volumes.append(vol_spec)
+    if service.volumes_from:
+        for external_volume in service.volumes_from:
+            for vol_spec in external_volume.source.options['volumes']:
+                service_volumes.append(vol_spec)
 
-        spec = pod_spec['spec']['containers'][0]
+    spec = pod_spec['spec']['containers'][0]
 
-        restart_policy = _get_restart_policy(service.options.get('restart'))
-        if restart_policy:
-            spec['restartPolicy'] = restart_policy
+    restart_policy = _get_restart_policy(service.options.get('restart'))
+    if restart_policy:
+        spec['restartPolicy'] = restart_policy
 
-        if 'environment' in service.options:
-            environment = service.options['environment']
-            spec['env'] = [
-                {"name": str(key), "value": environment[key]}
-                for key in environment
-            ]
+    if 'environment' in service.options:
+        environment = service.options['environment']
+        spec['env'] = [
+            {"name": str(key), "value": environment[key]}
+            for key in environment
+        ]
 
-        if 'command' in service.options:
-            spec['args'] = service.options['command']
+    if 'command' in service.options:
+        spec['args'] = service.options['command']
 
-        if 'entrypoint' in service.options:
-            spec['command'] = [service.options['entrypoint']]
+    if 'entrypoint' in service.options:
+        spec['command'] = [service.options['entrypoint']]
 
-        if service_volumes:
-            volumeMounts, volumes = [], []
+    if service_volumes:
+        volumeMounts, volumes = [], []
 
-            for vol in service_volumes:
-                vol_name = os.path.basename(vol.external).replace('_', '-')
-                volumeMounts.append(
-                    {"name": vol_name, "mountPath": vol.internal})
+        for vol in service_volumes:
+            vol_name = os.path.basename(vol.external).replace('_', '-')
+            volumeMounts.append(
+                {"name": vol_name, "mountPath": vol.internal})
 
-                if '/' in vol.external:
-                    volumes.append(
-                        {"name": vol_name, "hostPath": {"path": vol.external}})
-                else:
-                    found = False
-                    for _vname, _vol in project.volumes.volumes.items():
-                        if _vol.full_name == vol.external:
-                            found = True
-                            if _vol.driver == 'gce':
-                                volumes.append({
-                                    "name": vol_name,
-                                    "gcePersistentDisk": _vol.driver_opts
-                                })
-                            if _vol.driver == 'local' or _vol.driver is None:
-                                volumes.append(
-                                    {"name": vol_name, "emptyDir": {}})
-                            else:
-                                raise RuntimeError(
-                                    "Driver of type: %s is not yet supported" %
-                                    _vol.driver)
-
-                    if not found:
-                        volumes.append({"name": vol_name, "emptyDir": {}})
-
-            if volumeMounts:
-                spec['volumeMounts'] = volumeMounts
-
-            if volumes:
-                pod_spec['spec']['volumes'] = volumes
-
-        dp_spec['spec']['template'] = pod_spec
-
-        port_bindings = build_port_bindings(service.options.get('ports', []))
-
-        for container_port, host_ports in port_bindings.items():
-            _port = container_port.split('/')[0]
-            _host_port = host_ports[0] or _port
-
-            svc_spec = {
-                "kind": "Service",
-                "apiVersion": "v1",
-                "metadata": {
-                    "name": service.name,
-                    "namespace": ns_name
-                },
-                "spec": {
-                    "ports": [{
-                        "port": int(_host_port),
-                        "targetPort": int(_port),
-                    }],
-                    "selector": {
-                        "app": service.name
-                    }
+            if '/' in vol.external:
+                volumes.append(
+                    {"name": vol_name, "hostPath": {"path": vol.external}})
+            else:
+                found = False
+                for _vname, _vol in project.volumes.volumes.items():
+                    if _vol.full_name == vol.external:
+                        found = True
+                        if _vol.driver == 'gce':
+                            volumes.append({
+                                "name": vol_name,
+                                "gcePersistentDisk": _vol.driver_opts
+                            })
+                        if _vol.driver == 'local' or _vol.driver is None:
+                            volumes.append(
+                                {"name": vol_name, "emptyDir": {}})
+                        else:
+                            raise RuntimeError(
+                                "Driver of type: %s is not yet supported" %
+                                _vol.driver)
+
+                if not found:
+                    volumes.append({"name": vol_name, "emptyDir": {}})
+
+        if volumeMounts:
+            spec['volumeMounts'] = volumeMounts
+
+        if volumes:
+            pod_spec['spec']['volumes'] = volumes
+
+    dp_spec['spec']['template'] = pod_spec
+
+    port_bindings = build_port_bindings(service.options.get('ports', []))
+
+    for container_port, host_ports in port_bindings.items():
+        _port = container_port.split('/')[0]
+        _host_port = host_ports[0] or _port
+
+        svc_spec = {
+            "kind": "Service",
+            "apiVersion": "v1",
+            "metadata": {
+                "name": service.name,
+                "namespace": ns_name,
+                "labels": dict(labels)
+            },
+            "spec": {
+                "ports": [{
+                    "port": int(_host_port),
+                    "targetPort": int(_port),
+                }],
+                "selector": {
+                    "app": service.name
                 }
             }
+        }
 
-            if int(_host_port) == 80:
-                svc_spec['spec']['type'] = "LoadBalancer"
+        if int(_host_port) == 80:
+            svc_spec['spec']['type'] = "LoadBalancer"
 
-            kube_objects.append(svc_spec)
+        kube_objects.append(svc_spec)
 
-        kube_objects.append(dp_spec)
+    kube_objects.append(dp_spec)
 
-        ignored_fields = ['cap_add', 'cap_drop', 'cgroup_parent', 'container_name', 
-            'devices', 'depends_on', 'dns', 'dns_search', 'tmpfs', 'extends', 
-            'external_links', 'extra_hosts', 'labels', 'links', 'logging']
+    ignored_fields = ['cap_add', 'cap_drop', 'cgroup_parent', 'container_name', 
+        'devices', 'depends_on', 'dns', 'dns_search', 'tmpfs', 'extends', 
+        'external_links', 'extra_hosts', 'labels', 'links', 'logging']
 
-        for field in ignored_fields:
-            if field in service.options:
-                print "warning: skipping: %s\n" % field
+    for field in ignored_fields:
+        if field in service.options:
+            print "warning: skipping: %s\n" % field
 
     return kube_objects
 
 
-def _execute_with_docker(cmd, dry_run=False):
-    errmsg = None
-    try:
-        print ["docker"] + cmd
-        return subprocess.check_output(["docker"] + cmd)
-    except subprocess.CalledProcessError, e:
-        errmsg = "Cannot communicate with docker daemon: " + str(e)
-    except OSError as e:
-        errmsg = "'docker' executable not found: " + str(e)
-
-    if errmsg:
-        raise RuntimeError(errmsg)
-
 def _get_restart_policy(options):
     if options:
         name = options['Name']
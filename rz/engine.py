@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import codecs
+import base64
+import socket
+import ssl
+import tarfile
+import tempfile
+import threading
+from six.moves import http_client
+from six.moves.urllib.parse import urlencode, quote
+from rz import ignore
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+DEFAULT_CERT_PATH = os.path.join(os.path.expanduser('~'), '.docker')
+API_VERSION    = 'v1.24'
+
+
+class EngineError(RuntimeError):
+    pass
+
+
+class UnixHTTPConnection(http_client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http_client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self.sock = sock
+
+
+class Engine(object):
+    """Docker Engine API client talking to the daemon socket directly.
+
+    Like the docker cli, a tcp `host` is reached over TLS when `tls_verify`
+    (DOCKER_TLS_VERIFY) is set, with the ca.pem, cert.pem and key.pem of
+    `cert_path` (DOCKER_CERT_PATH, ~/.docker otherwise).
+
+    The local image inventory is fetched once and then kept up to date by
+    the builds, pulls and tags made through this client."""
+
+    def __init__(self, host=None, timeout=None, tls_verify=None,
+                 cert_path=None):
+        host = host or os.environ.get('DOCKER_HOST') or \
+            'unix://' + DEFAULT_SOCKET
+        self.host, self.timeout = host, timeout
+
+        if tls_verify is None:
+            tls_verify = bool(os.environ.get('DOCKER_TLS_VERIFY'))
+        self.ssl_context = None
+        if tls_verify and not host.startswith('unix://'):
+            self.ssl_context = _ssl_context(
+                cert_path or os.environ.get('DOCKER_CERT_PATH') or
+                DEFAULT_CERT_PATH)
+
+        self._auths = {}
+        self._inventory = None
+        self._lock = threading.Lock()
+
+    def version(self):
+        return self._json('GET', '/version')
+
+    def images(self):
+        """Local images, indexed by every repo:tag they carry and by id."""
+        with self._lock:
+            if self._inventory is None:
+                inventory = {}
+                for image in self._json('GET', '/images/json',
+                                        params={'all': 1}):
+                    inventory[image['Id']] = image['Id']
+                    for repo_tag in image.get('RepoTags') or []:
+                        inventory[repo_tag] = image['Id']
+                self._inventory = inventory
+            return self._inventory
+
+    def image_id(self, name):
+        images = self.images()
+        if ':' not in name.rsplit('/', 1)[-1] and \
+                not name.startswith('sha256:'):
+            name += ':latest'
+        return images.get(name)
+
+    def build(self, context, tag, dockerfile='Dockerfile', buildargs=None,
+              echo=None):
+        rules = ignore.IgnoreRules.from_files(context, ['.dockerignore'])
+
+        with tempfile.TemporaryFile() as archive:
+            tar = tarfile.open(fileobj=archive, mode='w')
+            for relpath in rules.walk(context):
+                tar.add(os.path.join(context, relpath), arcname=relpath,
+                        recursive=False)
+            if rules.ignored(dockerfile):
+                tar.add(os.path.join(context, dockerfile), arcname=dockerfile)
+            tar.close()
+
+            archive.seek(0, os.SEEK_END)
+            length = archive.tell()
+            archive.seek(0)
+
+            params = {'t': tag, 'dockerfile': dockerfile, 'rm': 1}
+            if buildargs:
+                params['buildargs'] = json.dumps(buildargs)
+
+            image_id = None
+            for chunk in self._stream('POST', '/build', params=params,
+                                      body=archive,
+                                      headers={
+                                          'Content-Type': 'application/x-tar',
+                                          'Content-Length': str(length)}):
+                if 'aux' in chunk:
+                    image_id = chunk['aux'].get('ID')
+                _echo_progress(chunk, echo)
+
+        self._remember(image_id or self.inspect(tag)['Id'], tag)
+        return image_id
+
+    def pull(self, image, echo=None):
+        name, tag = _split_tag(image)
+        for chunk in self._stream('POST', '/images/create',
+                                  params={'fromImage': name, 'tag': tag},
+                                  headers=self._auth_header(name)):
+            _echo_progress(chunk, echo)
+
+        self._remember(self.inspect(image)['Id'], image)
+
+    def tag(self, image, target):
+        repo, tag = _split_tag(target)
+        self._json('POST', '/images/%s/tag' % quote(image, safe='/:'),
+                   params={'repo': repo, 'tag': tag})
+        self._remember(self.image_id(image) or image, target)
+
+    def inspect(self, image):
+        return self._json('GET', '/images/%s/json' % quote(image, safe='/:'))
+
+    def login(self, server, username, password):
+        auth = {'username': username or '', 'password': password or '',
+                'serveraddress': server}
+        resp = self._json('POST', '/auth', body=json.dumps(auth),
+                          headers={'Content-Type': 'application/json'})
+
+        if resp.get('IdentityToken'):
+            auth = {'identitytoken': resp['IdentityToken'],
+                    'serveraddress': server}
+        self._auths[re.sub(r'^https?://', '', server).rstrip('/')] = auth
+        return resp
+
+    def logged_in(self, server):
+        return re.sub(r'^https?://', '', server).rstrip('/') in self._auths
+
+    def push(self, image, echo=None):
+        """Pushes `image`, returning the digest and size the daemon reports
+        for it, plus the number of layer bytes actually uploaded."""
+
+        name, tag = _split_tag(image)
+        result, uploaded = {}, {}
+        for chunk in self._stream('POST',
+                                  '/images/%s/push' % quote(name, safe='/:'),
+                                  params={'tag': tag},
+                                  headers=self._auth_header(name)):
+            if 'aux' in chunk:
+                result = dict(chunk['aux'])
+            elif chunk.get('status') == 'Pushing' and chunk.get('id'):
+                current = (chunk.get('progressDetail') or {}).get('current', 0)
+                uploaded[chunk['id']] = max(uploaded.get(chunk['id'], 0),
+                                            current)
+            _echo_progress(chunk, echo)
+
+        result['Uploaded'] = sum(uploaded.values())
+        return result
+
+    def _auth_header(self, name):
+        server = name.split('/', 1)[0] if '/' in name else None
+        auth = self._auths.get(server)
+        if auth is None:
+            return {}
+
+        encoded = base64.urlsafe_b64encode(json.dumps(auth).encode('utf-8'))
+        return {'X-Registry-Auth': encoded.decode('ascii')}
+
+    def _remember(self, image_id, *names):
+        with self._lock:
+            if self._inventory is not None:
+                self._inventory[image_id] = image_id
+                for name in names:
+                    self._inventory[name] = image_id
+
+    def _connection(self):
+        if self.host.startswith('unix://'):
+            return UnixHTTPConnection(self.host[len('unix://'):],
+                                      timeout=self.timeout)
+        address = self.host.split('://', 1)[-1]
+        if self.ssl_context is not None:
+            return http_client.HTTPSConnection(address, timeout=self.timeout,
+                                               context=self.ssl_context)
+        return http_client.HTTPConnection(address, timeout=self.timeout)
+
+    def _request(self, method, path, params=None, body=None, headers=None):
+        url = '/%s%s' % (API_VERSION, path)
+        if params:
+            url += '?' + urlencode(params)
+
+        conn = self._connection()
+        try:
+            conn.request(method, url, body=body, headers=headers or {})
+            resp = conn.getresponse()
+        except (socket.error, http_client.HTTPException) as e:
+            conn.close()
+            raise EngineError(
+                "Cannot communicate with docker daemon: %s" % e)
+
+        if resp.status >= 400:
+            message = resp.read()
+            conn.close()
+            try:
+                message = json.loads(message)['message']
+            except (ValueError, KeyError):
+                pass
+            raise EngineError("%s %s: %s %s" %
+                              (method, path, resp.status, message))
+
+        return conn, resp
+
+    def _json(self, method, path, **kwargs):
+        conn, resp = self._request(method, path, **kwargs)
+        try:
+            data = resp.read()
+        finally:
+            conn.close()
+        return json.loads(data) if data else {}
+
+    def _stream(self, method, path, **kwargs):
+        """Yields the JSON progress messages of a streaming endpoint as they
+        arrive, raising on the first error message."""
+
+        conn, resp = self._request(method, path, **kwargs)
+        decoder, buf = json.JSONDecoder(), u''
+        utf8 = codecs.getincrementaldecoder('utf-8')()
+        try:
+            while True:
+                data = resp.read(4096)
+                if not data:
+                    break
+
+                buf += utf8.decode(data)
+                while True:
+                    buf = buf.lstrip()
+                    if not buf:
+                        break
+                    try:
+                        chunk, end = decoder.raw_decode(buf)
+                    except ValueError:
+                        break
+                    buf = buf[end:]
+
+                    if 'error' in chunk:
+                        raise EngineError(chunk['error'])
+                    yield chunk
+        finally:
+            conn.close()
+
+
+def _ssl_context(cert_path):
+    context = ssl.create_default_context(
+        cafile=os.path.join(cert_path, 'ca.pem'))
+    context.load_cert_chain(os.path.join(cert_path, 'cert.pem'),
+                            os.path.join(cert_path, 'key.pem'))
+    return context
+
+
+def _split_tag(image):
+    name, _, tag = image.rpartition(':')
+    if not name or '/' in tag:
+        return image, 'latest'
+    return name, tag
+
+
+def _echo_progress(chunk, echo):
+    if echo is None:
+        return
+
+    if chunk.get('stream'):
+        echo(chunk['stream'].rstrip('\n'))
+    elif chunk.get('status'):
+        # layer progress bars are too chatty, just report the state changes
+        if 'progressDetail' in chunk and chunk['progressDetail']:
+            return
+        echo(' '.join(filter(None, [chunk.get('id'), chunk['status']])))
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def default_engine():
+    """Engine shared by the whole run, so the image inventory is only
+    queried once."""
+
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Engine()
+        return _default
@@ -1,13 +1,113 @@
 import os
+import six
+import sys
 import time
+import zlib
+import hashlib
+import socket
+import struct
+import httplib2
+import threading
 import tempfile
 import tarfile
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from googleapiclient import discovery, http
+from googleapiclient.discovery_cache.base import Cache
 from googleapiclient.errors import HttpError
 from oauth2client.client import GoogleCredentials
+from rz import ignore
 
 
-def archive_codebase(path, project_id, bucket=None):
+def _echo(message):
+    print message
+
+
+DISCOVERY_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rz',
+                                   'discovery')
+DISCOVERY_CACHE_TTL = 24 * 60 * 60
+
+_credentials = None
+_services = {}
+_services_lock = threading.Lock()
+
+
+class DiscoveryCache(Cache):
+    """Keeps discovery documents on disk for `ttl` seconds."""
+
+    def __init__(self, path=DISCOVERY_CACHE_DIR, ttl=DISCOVERY_CACHE_TTL):
+        self.path, self.ttl = path, ttl
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as fp:
+                return fp.read()
+        except (IOError, OSError):
+            return None
+
+    def set(self, url, content):
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+
+            # write then rename, so concurrent runs never read half a file
+            fd, tmp = tempfile.mkstemp(dir=self.path)
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(content)
+            os.rename(tmp, self._path(url))
+        except (IOError, OSError):
+            pass
+
+    def _path(self, url):
+        return os.path.join(self.path,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+
+def get_credentials():
+    global _credentials
+    with _services_lock:
+        if _credentials is None:
+            _credentials = GoogleCredentials.get_application_default()
+        return _credentials
+
+
+def get_service(name, version, **kwargs):
+    """Discovery based service for the process, built once per api. Its http
+    object isn't thread safe: other threads have to pass their own `http` to
+    execute()."""
+
+    credentials = get_credentials()
+    key = (name, version, tuple(sorted(kwargs.items())))
+
+    with _services_lock:
+        if key not in _services:
+            _services[key] = discovery.build(name, version,
+                                             credentials=credentials,
+                                             cache=DiscoveryCache(),
+                                             **kwargs)
+        return _services[key]
+
+
+# the archive holds every service's build context, a .dockerignore only
+# applies within its own context and is left for the docker build to apply
+IGNORE_FILES    = ['.gcloudignore']
+DEFAULT_IGNORES = ['.git']
+
+GZIP_BLOCK_SIZE = 1024 * 1024
+ARCHIVE_MTIME   = 315532800  # 1980-01-01, like other reproducible builds
+
+UPLOAD_PART_SIZE   = 32 * 1024 * 1024
+UPLOAD_CONCURRENCY = 8
+UPLOAD_RETRIES     = 3
+COMPOSE_LIMIT      = 32
+
+
+def archive_codebase(path, project_id, bucket=None, echo=_echo,
+                     workers=None, level=6):
     project_id = project_id or os.getenv('GCP_PROJECT_ID')
     if project_id is None:
         raise RuntimeError("Missing project_id.")
@@ -15,45 +115,141 @@ def archive_codebase(path, project_id, bucket=None):
     if bucket is None:
         bucket = '%s-cbstorage' % project_id
 
+    rules = ignore.IgnoreRules.from_files(path, IGNORE_FILES,
+                                          defaults=DEFAULT_IGNORES)
+
     archive = tempfile.NamedTemporaryFile(delete=False, suffix='.tar.gz')
-    tar = tarfile.open(fileobj=archive, mode='w:gz')
-    print "Archiving %s to %s" % (path, archive.name)
+    echo("Archiving %s to %s" % (path, archive.name))
 
-    for spath, subdirs, files in os.walk(path):
-        for name in files:
-            print 'Adding %s' % os.path.relpath(
-                os.path.join(spath, name), path)
+    started, count, size = time.time(), 0, 0
+    gz = _ParallelGzipWriter(archive, workers, level)
+    tar = tarfile.open(fileobj=gz, mode='w|')
 
-            tar.add(os.path.join(spath, name), recursive=False,
-                    arcname=os.path.relpath(os.path.join(spath, name), path))
+    for relpath in rules.walk(path):
+        info = _reproducible(tar.gettarinfo(os.path.join(path, relpath),
+                                            arcname=relpath))
+        if info.isreg():
+            with open(os.path.join(path, relpath), 'rb') as fp:
+                tar.addfile(info, fp)
+        else:
+            tar.addfile(info)
+
+        count += 1
+        size += info.size
 
     tar.close()
+    gz.close()
     archive.close()
 
+    echo("Archived %d files (%.1f MB) into %.1f MB in %.1fs" % (
+        count, size / 1048576.0, os.path.getsize(archive.name) / 1048576.0,
+        time.time() - started))
+
     return bucket, archive
 
 
-def upload_to_gcr(project_id, bucket, archive):
-    source_key = os.path.basename(archive.name)
+def _reproducible(info):
+    """Drops what differs between checkouts of the same tree (owners and
+    mtimes) from a tar entry, so equal trees give equal archives."""
 
-    print 'Checking for bucket %s...' % bucket
-    credentials = GoogleCredentials.get_application_default()
+    info.mtime = ARCHIVE_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = ''
+    info.mode = 0o755 if info.mode & 0o100 else 0o644
+    return info
 
-    gcs_service = discovery.build('storage', 'v1', credentials=credentials)
+
+class _ParallelGzipWriter(object):
+    """File-like object gzipping what is written to it on a pool of threads.
+    Every block becomes its own gzip member, concatenated in order, which
+    any gzip reader decompresses as a single stream."""
+
+    def __init__(self, fileobj, workers=None, level=6):
+        self.fileobj, self.level = fileobj, level
+        self.workers = workers or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.workers)
+        self.pending = collections.deque()
+        self.buf = []
+        self.buf_size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+
+        if self.buf_size >= GZIP_BLOCK_SIZE:
+            self._submit()
+
+    def close(self):
+        if self.buf_size:
+            self._submit()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+
+        self.pool.close()
+        self.pool.join()
+
+    def _submit(self):
+        block = b''.join(self.buf)
+        self.buf, self.buf_size = [], 0
+        self.pending.append(
+            self.pool.apply_async(_gzip_member, (block, self.level)))
+
+        # keep a bounded number of blocks in flight
+        while len(self.pending) > 2 * self.workers or \
+                (self.pending and self.pending[0].ready()):
+            self.fileobj.write(self.pending.popleft().get())
+
+
+def _gzip_member(block, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(block) + compressor.flush()
+
+    # no name and a zero mtime, so equal input yields equal bytes
+    header = b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + b'\x00\xff'
+    trailer = struct.pack('<II', zlib.crc32(block) & 0xffffffff,
+                          len(block) & 0xffffffff)
+    return header + body + trailer
+
+
+def upload_to_gcr(project_id, bucket, archive, echo=_echo,
+                  part_size=UPLOAD_PART_SIZE, concurrency=UPLOAD_CONCURRENCY):
+    """Uploads `archive` as source/<sha256>.tar.gz, unless the bucket already
+    has an object by that name, and returns the object name. Archives larger
+    than `part_size` go up as parts on `concurrency` threads and are composed
+    into one object server side."""
+
+    source_key = 'source/%s.tar.gz' % _sha256(archive.name)
+
+    echo('Checking for bucket %s...' % bucket)
+    credentials = get_credentials()
+    gcs_service = get_service('storage', 'v1')
     req = gcs_service.buckets().get(bucket=bucket)
 
     try:
         req.execute()
     except HttpError, error:
         if error.resp.status == 404:
-            print 'Bucket %s not found, attempting to create it...' % bucket
+            echo('Bucket %s not found, attempting to create it...' % bucket)
             req = gcs_service.buckets().insert(
                 project=project_id, body={'name': bucket})
             resp = req.execute()
         else:
             raise error
 
-    print 'Uploading %s to %s...' % (source_key, bucket)
+    try:
+        gcs_service.objects().get(bucket=bucket, object=source_key).execute()
+        echo('%s already in %s, skipping upload' % (source_key, bucket))
+        return source_key
+    except HttpError, error:
+        if error.resp.status != 404:
+            raise error
+
+    echo('Uploading %s to %s...' % (source_key, bucket))
+
+    if concurrency > 1 and os.path.getsize(archive.name) > part_size:
+        _parallel_upload(gcs_service, credentials, bucket, source_key,
+                         archive.name, part_size, concurrency, echo)
+        return source_key
 
     try:
         body = {'name': source_key}
@@ -69,8 +265,8 @@ def upload_to_gcr(project_id, bucket, archive):
         while resp is None:
             status, resp = req.next_chunk()
             if status:
-                print "Uploaded %d%%." % int(status.progress() * 100)
-        print '...done!'
+                echo("Uploaded %d%%." % int(status.progress() * 100))
+        echo('...done!')
     except HttpError, error:
         if error.resp.status == 403:
             raise Exception(
@@ -83,8 +279,200 @@ def upload_to_gcr(project_id, bucket, archive):
     return source_key
 
 
-def build_from_gcr(project_id, bucket, source_key, image_uri, build_options={}):
-    # Invoke the container builder API
+def _parallel_upload(gcs_service, credentials, bucket, source_key, path,
+                     part_size, concurrency, echo):
+    size = os.path.getsize(path)
+    parts = ['%s.part-%04d' % (source_key, i)
+             for i in range(0, (size + part_size - 1) // part_size)]
+    local = threading.local()
+    done = []
+
+    def thread_http():
+        # httplib2 connections can't be shared between threads
+        if not hasattr(local, 'http'):
+            local.http = credentials.authorize(httplib2.Http())
+        return local.http
+
+    def execute(req):
+        return _with_retries(lambda: req.execute(http=thread_http()))
+
+    def upload(index):
+        offset = index * part_size
+        part = _FileSlice(path, offset, min(part_size, size - offset))
+
+        def send():
+            media = http.MediaIoBaseUpload(
+                part, mimetype='application/octet-stream',
+                chunksize=4194304, resumable=True)
+            req = gcs_service.objects().insert(
+                bucket=bucket, name=parts[index], media_body=media)
+            resp = None
+            while resp is None:
+                _, resp = req.next_chunk(http=thread_http())
+            return resp
+
+        try:
+            _with_retries(send)
+        finally:
+            part.close()
+
+        done.append(index)
+        echo("Uploaded part %d/%d." % (len(done), len(parts)))
+
+    def compose(sources, destination):
+        execute(gcs_service.objects().compose(
+            destinationBucket=bucket,
+            destinationObject=destination,
+            body={
+                'sourceObjects': [{'name': name} for name in sources],
+                'destination': {
+                    'contentType': 'application/x-gzip',
+                    'cacheControl': 'public,max-age=31536000'
+                }
+            }))
+
+    def delete(name):
+        try:
+            execute(gcs_service.objects().delete(bucket=bucket, object=name))
+        except HttpError:
+            pass
+
+    def run_all(func, args):
+        # unlike map, waits for every call before raising the first error,
+        # so nothing is still being written when the cleanup runs
+        pending = [pool.apply_async(func, (arg,)) for arg in args]
+        for result in pending:
+            result.wait()
+        return [result.get() for result in pending]
+
+    pool = ThreadPool(concurrency)
+    # parts and intermediate objects go whether or not the upload made it,
+    # deleting names that were never written is harmless
+    temporary = list(parts)
+    try:
+        run_all(upload, range(len(parts)))
+
+        # a compose takes at most 32 sources, so compose large uploads in
+        # rounds of intermediate objects
+        sources, level = parts, 0
+        while len(sources) > COMPOSE_LIMIT:
+            level += 1
+            batches = [sources[i:i + COMPOSE_LIMIT]
+                       for i in range(0, len(sources), COMPOSE_LIMIT)]
+            sources = ['%s.compose-%d-%04d' % (source_key, level, i)
+                       for i in range(len(batches))]
+            temporary.extend(sources)
+            run_all(lambda args: compose(*args), zip(batches, sources))
+
+        compose(sources, source_key)
+        echo('...done!')
+    finally:
+        try:
+            pool.map(delete, temporary)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def _with_retries(func, retries=UPLOAD_RETRIES):
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except (HttpError, socket.error, httplib2.HttpLib2Error) as error:
+            status = getattr(getattr(error, 'resp', None), 'status', None)
+            if attempt == retries or (status is not None and
+                                      status < 500 and status != 429):
+                raise
+            time.sleep(2 ** attempt)
+
+
+class _FileSlice(object):
+    """Read-only view of `length` bytes of a file starting at `offset`."""
+
+    def __init__(self, path, offset, length):
+        self.fp = open(path, 'rb')
+        self.offset, self.length, self.pos = offset, length, 0
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self.pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        self.pos = max(0, min(pos, self.length))
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.length - self.pos:
+            size = self.length - self.pos
+        self.fp.seek(self.offset + self.pos)
+        data = self.fp.read(size)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.fp.close()
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1048576), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+BUILD_POLL_MIN = 1
+BUILD_POLL_MAX = 16
+
+BUILD_PENDING_STATES = ['STATUS_UNKNOWN', 'QUEUED', 'QUEUING', 'WORKING']
+
+
+class CloudBuild(object):
+    """A submitted Cloud Build and what's known about it so far."""
+
+    def __init__(self, image_uri, operation):
+        self.image_uri = image_uri
+        self.operation = operation['name']
+        self.id        = operation['metadata']['build']['id']
+        self.status    = operation['metadata']['build']['status']
+        self.images    = {}
+        self.started   = time.time()
+        self.duration  = 0
+
+    @property
+    def done(self):
+        return self.status not in BUILD_PENDING_STATES
+
+    @property
+    def ok(self):
+        return self.status == 'SUCCESS'
+
+    @property
+    def digest(self):
+        return self.images.get(self.image_uri)
+
+    def update(self, operation):
+        """Takes in a polled operation, returns whether the status moved."""
+        build = operation['metadata']['build']
+        changed = build['status'] != self.status
+        self.status = build['status']
+
+        for image in build.get('results', {}).get('images', []):
+            self.images[image['name']] = image['digest']
+
+        if self.done and changed:
+            self.duration = time.time() - self.started
+        return changed
+
+    def __repr__(self):
+        return "<CloudBuild %s %s: %s>" % (self.id, self.image_uri,
+                                           self.status)
+
+
+def build_request(bucket, source_key, image_uri, build_options={},
+                  aliases=()):
     cb_request_body = {
         "source": {
             "storageSource": {
@@ -102,33 +490,91 @@ def build_from_gcr(project_id, bucket, source_key, image_uri, build_options={}):
                 ]
             }
         ],
-        "images": [image_uri]
+        "images": [image_uri] + list(aliases)
     }
 
-    credentials = GoogleCredentials.get_application_default()
-    ccb_service = discovery.build('cloudbuild', 'v1', credentials=credentials, discoveryServiceUrl=\
+    # tag the built image for every other service sharing this build
+    for alias in aliases:
+        cb_request_body['steps'].append({
+            "name": "gcr.io/cloud-builders/docker",
+            "args": ["tag", image_uri, alias]
+        })
+
+    return cb_request_body
+
+
+def run_builds(project_id, bucket, source_key, builds, echo=_echo,
+               fail_fast=False):
+    """Submits every (image_uri, build_options, aliases) build up front, then
+    tracks them together, polling more often while their statuses change and
+    backing off while they don't. With `fail_fast`, the first failure cancels
+    the builds still running. Returns a CloudBuild per build, in order."""
+
+    ccb_service = get_service('cloudbuild', 'v1', discoveryServiceUrl=\
                     "https://content-cloudbuild.googleapis.com/$discovery/rest?version=v1")
 
-    req = ccb_service.projects().builds().create(
-            projectId=project_id, body=cb_request_body
-    )
-    resp = req.execute()
-
-    if resp['metadata']['build']['status'] in ['QUEUED', 'QUEUING']:
-        print 'Queued build %s' % resp['metadata']['build']['id']
-
-        operation_id = resp['name']
-        while resp['metadata']['build']['status'] in ['QUEUED', 'QUEUING', 'WORKING']:
-            resp = ccb_service.operations().get(name=operation_id).execute()
-            print 'Building... %s' % resp['metadata']['build']['status']
-            time.sleep(2)
-
-    if resp['metadata']['build']['status'] == 'SUCCESS':
-        resp = ccb_service.operations().get(name=operation_id).execute()
-        for image in resp['metadata']['build']['results']['images']:
-            print 'Built %s' % image['name']
-            print '(Image digest: %s)' % image['digest']
-    else:
-        print 'Build returned %s - check build ID %s' % (
-            resp['metadata']['build']['status'],
-            resp['metadata']['build']['id'])
+    tracked = []
+
+    def cancel():
+        for build in tracked:
+            if not build.done:
+                echo('Cancelling build %s for %s' %
+                     (build.id, build.image_uri))
+                ccb_service.projects().builds().cancel(
+                    projectId=project_id, id=build.id, body={}).execute()
+                build.status = 'CANCELLED'
+
+    try:
+        for image_uri, build_options, aliases in builds:
+            resp = ccb_service.projects().builds().create(
+                    projectId=project_id,
+                    body=build_request(bucket, source_key, image_uri,
+                                       build_options, aliases)
+            ).execute()
+
+            build = CloudBuild(image_uri, resp)
+            echo('Queued build %s for %s' % (build.id, image_uri))
+            tracked.append(build)
+
+        delay = BUILD_POLL_MIN
+        pending = [b for b in tracked if not b.done]
+
+        while pending:
+            time.sleep(delay)
+
+            changed = False
+            for build in pending:
+                resp = ccb_service.operations().get(
+                    name=build.operation).execute()
+                if build.update(resp):
+                    changed = True
+                    echo('%s: %s' % (build.image_uri, build.status))
+
+            if fail_fast and any(b.done and not b.ok for b in tracked):
+                cancel()
+
+            pending = [b for b in tracked if not b.done]
+            delay = BUILD_POLL_MIN if changed else min(delay * 2,
+                                                       BUILD_POLL_MAX)
+    except BaseException:
+        # don't leave builds running (and billed) nobody waits for anymore
+        exc_info = sys.exc_info()
+        try:
+            cancel()
+        except Exception:
+            pass
+        six.reraise(*exc_info)
+
+    return tracked
+
+
+def build_from_gcr(project_id, bucket, source_key, image_uri, build_options={},
+                   echo=_echo, aliases=()):
+    build = run_builds(project_id, bucket, source_key,
+                       [(image_uri, build_options, aliases)], echo)[0]
+
+    if not build.ok:
+        raise RuntimeError('Build returned %s - check build ID %s' % (
+            build.status, build.id))
+
+    return build
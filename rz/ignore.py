@@ -0,0 +1,99 @@
+import os
+import re
+
+
+class IgnoreRules(object):
+    """`.dockerignore` style patterns: `*`, `?` and `**` wildcards, `!` for
+    exceptions, the last matching pattern wins. A pattern matching a
+    directory also matches everything below it."""
+
+    def __init__(self, patterns=None):
+        self.patterns = []
+
+        for pattern in patterns or []:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:].strip()
+
+            pattern = os.path.normpath(pattern).lstrip('/')
+            self.patterns.append((negate, _compile(pattern)))
+
+    @classmethod
+    def from_files(cls, root, names, defaults=None):
+        patterns = list(defaults or [])
+        for name in names:
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                with open(path) as fp:
+                    patterns.extend(fp.read().splitlines())
+
+        return cls(patterns)
+
+    def ignored(self, relpath):
+        parts = relpath.split(os.sep)
+        candidates = ['/'.join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+        ignored = False
+        for negate, regex in self.patterns:
+            if any(regex.match(c) for c in candidates):
+                ignored = not negate
+
+        return ignored
+
+    def walk(self, root):
+        """Yields the paths (relative to `root`) of files that aren't ignored,
+        in a stable order."""
+
+        # with exceptions around, an ignored directory may still have files
+        # we need, so only prune when there are none
+        can_prune = not any(negate for negate, _ in self.patterns)
+
+        for spath, subdirs, files in os.walk(root):
+            rel = os.path.relpath(spath, root)
+            rel = '' if rel == os.curdir else rel
+
+            subdirs[:] = sorted(
+                d for d in subdirs
+                if not (can_prune and self.ignored(os.path.join(rel, d))))
+
+            for name in sorted(files):
+                relpath = os.path.join(rel, name)
+                if not self.ignored(relpath):
+                    yield relpath
+
+
+def _compile(pattern):
+    i, regex = 0, ''
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern[i:i + 3] == '**/':
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        elif pattern[i:i + 2] == '**':
+            regex += '.*'
+            i += 2
+            continue
+        elif c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(c)
+            else:
+                chars = pattern[i + 1:end].replace('\\', '\\\\')
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                regex += '[' + chars + ']'
+                i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+
+    return re.compile(regex + '$')
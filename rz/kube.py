@@ -1,11 +1,17 @@
 import pykube
-import backports
+import backports.ssl_match_hostname
 import click
 import time
 import os
+import copy
 import json
 import re
-from six.moves.urllib.parse import urlencode
+import threading
+import heapq
+import codecs
+import requests
+from six.moves import queue
+from multiprocessing.pool import ThreadPool
 
 # Monkey-patch match_hostname with backports's match_hostname, allowing for IP addresses
 # XXX: the exception that this might raise is
@@ -20,19 +26,61 @@ def get_entity(pykube_object):
     )
 
 
+class _TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+
+
 class Client:
+    """Long-lived kubernetes client, one HTTP connection pool per context.
+    Cached lookups only see objects in `namespace` (all namespaces if None)
+    matching the label `selector`."""
 
-    def __init__(self, context=None):
+    pool_size = 10
+    timeout   = 30
+
+    _apis = {}
+    _informers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, context=None, pool_size=None, timeout=None,
+                 namespace=None, selector=None):
         self.context = context
+        self.namespace = namespace
+        self.selector = selector
+        if pool_size is not None:
+            self.pool_size = pool_size
+        if timeout is not None:
+            self.timeout = timeout
 
     @property
     def api(self):
+        key = (self.context, self.pool_size, self.timeout)
+        with Client._lock:
+            if key not in Client._apis:
+                Client._apis[key] = self._build_api()
+            return Client._apis[key]
+
+    def _build_api(self):
         config = pykube.KubeConfig.from_file(
             os.path.join(os.environ['HOME'], ".kube/config"))
         if self.context:
             config.set_current_context(self.context)
 
-        return pykube.HTTPClient(config)
+        api = pykube.HTTPClient(config)
+        adapter = _TimeoutHTTPAdapter(timeout=self.timeout,
+                                      pool_connections=self.pool_size,
+                                      pool_maxsize=self.pool_size)
+        api.session.mount('https://', adapter)
+        api.session.mount('http://', adapter)
+        return api
 
     def object(self, kube_object):
         underlying = getattr(pykube, kube_object['kind'])
@@ -43,29 +91,155 @@ class Client:
 
         return underlying.__call__(self.api, kube_object)
 
-    def get_by_name(self, kind, name):
-        return getattr(pykube, kind).objects(self.api).get_or_none(name=name)
+    def informer(self, kind):
+        """The process wide cache of `kind` objects for this context and
+        scope."""
+        key = (self.context, kind, self.namespace, self.selector)
+        with Client._lock:
+            informer = Client._informers.get(key)
+        if informer is not None:
+            return informer
+
+        informer = Informer(self.api, kind, self.namespace, self.selector)
+        with Client._lock:
+            if key in Client._informers:
+                return Client._informers[key]
+            Client._informers[key] = informer
+
+        informer.start()
+        return informer
+
+    def get_by_name(self, kind, name, namespace=None):
+        obj = self.informer(kind).get(name, namespace)
+        if obj is None:
+            return None
+
+        return _entity_class(kind)(self.api, obj)
+
+    def list(self, kind, namespace=None):
+        entity = _entity_class(kind)
+        return [entity(self.api, obj)
+                for obj in self.informer(kind).list(namespace)]
 
     def get_deplopyment_revisions(self):
         revisions = []
-        for dp in pykube.Deployment.objects(self.api):
-            revision = _get_deployment_revision(dp.obj)
+        for obj in self.informer('Deployment').list():
+            revision = _get_deployment_revision(obj)
             if revision and revision not in revisions:
                 revisions.append(revision)
 
-        revisions.sort()
+        revisions.sort(key=int)
         return revisions
 
 
+class Informer(object):
+    """In-memory copy of every object of a kind (in `namespace` and matching
+    the label `selector`, when given), indexed by namespace and name. It
+    lists the kind once and then follows a watch in the background to stay
+    current. Lookups hand out copies."""
+
+    def __init__(self, api, kind, namespace=None, selector=None):
+        self.api, self.kind = api, kind
+        self.resource = _entity_class(kind)
+        self.objects = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        self.namespace = namespace if self._namespaced() else None
+        self.params = {'labelSelector': selector} if selector else {}
+
+    def start(self):
+        r = self.api.get(url=self.resource.endpoint,
+                         namespace=self.namespace,
+                         version=self.resource.version,
+                         params=self.params)
+        self.api.raise_for_status(r)
+        listing = r.json()
+
+        with self._lock:
+            for obj in listing['items']:
+                self._store('ADDED', obj)
+
+        thread = threading.Thread(
+            target=self._follow,
+            args=(listing['metadata']['resourceVersion'],))
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def get(self, name, namespace=None):
+        # as with pykube, namespaced objects without one live in 'default'
+        if self._namespaced():
+            namespace = namespace or pykube.objects.DEFAULT_NAMESPACE
+        else:
+            namespace = None
+
+        with self._lock:
+            return copy.deepcopy(self.objects.get((namespace, name)))
+
+    def list(self, namespace=None):
+        with self._lock:
+            return [copy.deepcopy(obj)
+                    for (ns, name), obj in sorted(self.objects.items())
+                    if namespace is None or ns == namespace]
+
+    def _namespaced(self):
+        return issubclass(self.resource, pykube.objects.NamespacedAPIObject)
+
+    def _follow(self, resource_version):
+        while not self._stop.is_set():
+            with self._lock:
+                items = list(self.objects.values())
+            try:
+                for event_type, obj in watch(
+                        self.api, self.resource.endpoint,
+                        namespace=self.namespace,
+                        version=self.resource.version,
+                        resource_version=resource_version,
+                        stop=self._stop, items=items, **self.params):
+                    with self._lock:
+                        self._store(event_type, obj)
+            except Exception as e:
+                click.echo("watch on %s failed, retrying: %s" % (self.kind, e))
+                time.sleep(1)
+
+            # start over from a fresh listing, whatever was missed meanwhile
+            # comes out of it
+            resource_version = None
+
+    def _store(self, event_type, obj):
+        obj.setdefault('kind', self.kind)
+        key = (obj['metadata'].get('namespace'), obj['metadata']['name'])
+
+        if event_type == 'DELETED':
+            self.objects.pop(key, None)
+        else:
+            self.objects[key] = obj
+
+
 POD_NOT_READY   = 'not_ready'
 POD_RUNNING     = 'running'
 POD_FAILED      = 'failed'
 
+MAX_RESTARTS    = 3
+
 PHASE_UNKNOWN   = 'unknown'
 PHASE_RUNNING   = 'running'
 PHASE_FAILED    = 'failed'
 PHASE_SUCCEEDED = 'succeeded'
 
+ROLLOUT_TIMEOUT  = 600
+TEARDOWN_TIMEOUT = 300
+ROLLBACK_TIMEOUT = 300
+WATCH_TIMEOUT    = 60
+
+LOG_TAIL_LINES  = 500
+LOG_LIMIT_BYTES = 1024 * 1024
+LOG_CHUNK_SIZE  = 16 * 1024
+LOG_WORKERS     = 8
+
 CONTAINER_ERROR_STATES = [
     'CrashLoopBackOff',
     'ImagePullBackOff',
@@ -99,81 +273,135 @@ class Deployment(pykube.Deployment):
     def __init__(self, *args):
         pykube.Deployment.__init__(self, *args)
 
-    def rollback(self, to_version=0):
-        r_version = Event.objects(self.api).filter().response['metadata']['resourceVersion']
+    def rollback(self, to_version=0, timeout=ROLLBACK_TIMEOUT):
+        """Rolls back to `to_version` (0 being the previous revision), then
+        waits for the rollout of the old template. Events about this
+        deployment are watched rather than polled; gives up after
+        `timeout` seconds. Returns (success, error)."""
+
+        deadline = time.time() + timeout
+        selector = 'involvedObject.kind=Deployment,involvedObject.name=%s' % \
+            self.name
+
+        r = self.api.get(url='events', namespace=self.namespace,
+                         params={'fieldSelector': selector})
+        self.api.raise_for_status(r)
+        listing = r.json()
 
         rollback_object = dict(name=self.name, rollbackTo={'revision': to_version})
         r = self.api.post(**self.api_kwargs(
                 operation='rollback',
                 data=json.dumps(rollback_object)
         ))
-
         self.api.raise_for_status(r)
-        done, success, error = False, False, None
-
-        while not done:
-            for event in Event.objects(self.api).filter(resource_version=r_version):
-                ev = event.obj
-                if ev['reason'] == 'DeploymentRollbackRevisionNotFound':
-                    done, error = True, ev['message']
-                else:
-                    success = ev['reason'] == 'DeploymentRollback'
-                    done    = success
 
-            time.sleep(2)
+        for event_type, ev in watch(self.api, 'events',
+                                    namespace=self.namespace,
+                                    resource_version=listing['metadata']
+                                    ['resourceVersion'],
+                                    items=listing['items'],
+                                    deadline=deadline,
+                                    fieldSelector=selector):
+            if ev['reason'] == 'DeploymentRollbackRevisionNotFound':
+                return False, ev['message']
+            elif ev['reason'] == 'DeploymentRollbackTemplateUnchanged':
+                return True, None
+            elif ev['reason'] == 'DeploymentRollback':
+                break
+        else:
+            return False, "no rollback event for %s within %ds" % \
+                (self, timeout)
 
-        return success, error
+        _, status = check_rollouts([self], max(0, deadline - time.time()))[0]
+        if status != PHASE_RUNNING:
+            return False, "rollout of %s did not complete" % self
+        return True, None
 
     @property
     def revision(self):
         return _get_deployment_revision(self.obj)
 
-    def reap(self):
+    def reap(self, timeout=TEARDOWN_TIMEOUT):
+        """Scales the deployment to zero, returns whether all its pods were
+        gone within `timeout` seconds."""
         self.obj['spec']['replicas'] = 0
         self.update()
 
-        while self.obj['spec']['replicas'] > 0:
-            time.sleep(1)
-            click.echo("checking pod status for %s" % self)
-            self.reload()
-
-    def check_status(self):
-        match_selector = self.obj['spec']['selector']['matchLabels']
-        failing_pods, status = [], PHASE_UNKNOWN
+        click.echo("waiting for pods of %s to terminate" % self)
+        return self.wait_for_pods_gone(time.time() + timeout)
+
+    def delete(self, propagation='Background'):
+        """Deletes the deployment along with its replica sets (and pods).
+        With 'Foreground' propagation the deployment itself stays around
+        until they are all gone."""
+        r = self.api.delete(**self.api_kwargs(data=json.dumps({
+            'kind': 'DeleteOptions',
+            'apiVersion': 'v1',
+            'propagationPolicy': propagation
+        })))
+        # already gone, like pykube's own delete
+        if r.status_code != 404:
+            self.api.raise_for_status(r)
+
+    def wait_for_pods_gone(self, deadline):
+        return wait_until_gone(self.api, 'pods', deadline,
+                               namespace=self.namespace,
+                               labelSelector=self.pod_selector)
+
+    def wait_until_deleted(self, deadline):
+        return wait_until_gone(self.api, self.endpoint, deadline,
+                               namespace=self.namespace,
+                               version=self.version,
+                               fieldSelector='metadata.name=%s' % self.name)
+
+    def check_status(self, timeout=ROLLOUT_TIMEOUT):
+        return check_rollouts([self], timeout)[0]
 
-        while status == PHASE_UNKNOWN:
-            running_count = 0
-            ## check for newly created pods only ...
-            deployment_pods = pykube.Pod.objects(self.api).filter(
-                namespace=self.namespace,
-                selector=match_selector)
+    @property
+    def pod_selector(self):
+        return _label_selector(self.obj['spec']['selector']['matchLabels'])
 
-            for pod in deployment_pods:
-                pod = get_entity(pod)
-                phase, error = pod.current_phase()
+    def _rollout_status(self, phases):
+        failing_pods = [pod for pod, phase in phases.values()
+                        if phase == POD_FAILED]
+        if failing_pods:
+            return failing_pods, PHASE_FAILED
 
-                click.echo("pod %s: phase: %s error: %s" % (pod, phase, error))
+        replicas = self.obj['spec'].get('replicas', 1)
+        status   = self.obj.get('status', {})
+        running  = len([p for p, phase in phases.values()
+                        if phase == POD_RUNNING])
 
-                if phase == POD_RUNNING:
-                    running_count += 1
-                elif phase == POD_FAILED:
-                    status = PHASE_FAILED
-                    failing_pods.append(pod)
+        rolled_out = (
+            status.get('observedGeneration', 0) >=
+                self.obj['metadata'].get('generation', 0) and
+            status.get('updatedReplicas', 0) == replicas and
+            status.get('availableReplicas', 0) >= replicas and
+            status.get('replicas', 0) == replicas)
 
-            if running_count == self.obj['status']['replicas']:
-                status = PHASE_RUNNING
-            else:
-                time.sleep(1)
+        if rolled_out and running >= replicas:
+            return [], PHASE_RUNNING
 
-        return failing_pods, status
+        return [], PHASE_UNKNOWN
 
 class Pod(pykube.Pod):
 
     def __init__(self, *args):
         pykube.Pod.__init__(self, *args)
 
-    def logs(self, container=None):
+    def logs(self, container=None, **options):
         """pykube doesn't have stable logs function yet"""
+        return u''.join(self.stream_logs(container, **options))
+
+    def stream_logs(self, container=None, tail_lines=None, limit_bytes=None,
+                    since_seconds=None, previous=False,
+                    chunk_size=LOG_CHUNK_SIZE):
+        """Yields the log of `container` in chunks as it comes off the wire,
+        limited server side to the last `tail_lines` lines, the first
+        `limit_bytes` bytes and the last `since_seconds` seconds. With
+        `previous` the log of the container's last terminated instance is
+        fetched instead, which is the useful one for crash looping
+        containers."""
 
         url = self.api.url + "/api/{}/namespaces/{}/pods/{}/log".format(
             self.version, self.namespace, self.name
@@ -182,58 +410,415 @@ class Pod(pykube.Pod):
 
         if container is not None:
             params['container'] = container
-
-        query_string = urlencode(params)
-        url += "?{}".format(query_string) if query_string else ""
-
-        r = self.api.session.get(url=url)
-        if r.headers.get('content-type') == 'application/json':
-            return r.json()['message']
-
-        return r.text
-
-    def current_phase(self, sleep_for=1):
-        status, error = POD_NOT_READY, None
-        back_off_timeout = 10
-
-        if self.ready:
-            status = POD_RUNNING
-            click.secho("All looks good for %s: %s" %
-                        (self, self.obj['status']['conditions']), bg='green')
+        if tail_lines is not None:
+            params['tailLines'] = tail_lines
+        if limit_bytes is not None:
+            params['limitBytes'] = limit_bytes
+        if since_seconds is not None:
+            params['sinceSeconds'] = since_seconds
+        if previous:
+            params['previous'] = 'true'
+
+        r = self.api.session.get(url=url, params=params, stream=True)
+        try:
+            if r.headers.get('content-type') == 'application/json':
+                yield r.json()['message']
+                return
+
+            utf8 = codecs.getincrementaldecoder('utf-8')('replace')
+            for data in r.iter_content(chunk_size):
+                yield utf8.decode(data)
+            yield utf8.decode(b'', True)
+        finally:
+            r.close()
+
+    def failing_containers(self):
+        """(name, previous) for each container that can't start or keeps
+        restarting, `previous` telling whether it has already crashed at
+        least once. Every container when none stands out."""
+
+        failing = []
+        for status in self.obj.get('status', {}).get('containerStatuses') or []:
+            waiting = status['state'].get('waiting') or {}
+            restarted = status.get('restartCount', 0) > 0
+            if restarted or waiting.get('reason') in CONTAINER_ERROR_STATES:
+                failing.append((status['name'], restarted))
+
+        return failing or [(c['name'], False)
+                           for c in self.obj['spec']['containers']]
+
+    def current_phase(self):
+        phase, error, _ = classify_pod(self.obj)
+        return phase, error
+
+
+def watch(api, url, namespace=None, version='v1', resource_version=None,
+          deadline=None, stop=None, items=None, **params):
+    """Yields (type, object) pairs from the kubernetes watch api, reconnecting
+    from the last seen resourceVersion until `deadline` passes. `items` are
+    the objects of the listing `resource_version` comes from. Once that
+    resourceVersion is compacted away (410 Gone) the objects are listed
+    again: what changed meanwhile comes out as ADDED/MODIFIED events, what
+    disappeared as DELETED ones, and the watch resumes from the listing."""
+
+    known = dict((_object_key(obj), obj) for obj in items or [])
+
+    while deadline is None or time.time() < deadline:
+        if stop is not None and stop.is_set():
+            return
+
+        if resource_version is None:
+            events, resource_version = _relist(api, url, namespace, version,
+                                               known, params)
+            for event in events:
+                yield event
+            continue
+
+        timeout = WATCH_TIMEOUT
+        if deadline is not None:
+            timeout = max(1, min(timeout, int(deadline - time.time())))
+
+        query = dict(params, watch='true', timeoutSeconds=timeout,
+                     resourceVersion=resource_version)
+
+        r = api.get(url=url, namespace=namespace, version=version,
+                    params=query, stream=True, timeout=timeout + 5)
+        if r.status_code == 410:
+            r.close()
+            resource_version = None
+            continue
+        api.raise_for_status(r)
+
+        try:
+            for line in r.iter_lines():
+                if not line:
+                    continue
+
+                event = json.loads(line)
+                obj = event['object']
+
+                if event['type'] == 'ERROR':
+                    # 410 Gone: our resourceVersion was compacted, relist
+                    if obj.get('code') == 410:
+                        resource_version = None
+                        break
+                    raise RuntimeError(obj.get('message'))
+
+                resource_version = obj['metadata']['resourceVersion']
+                if event['type'] == 'DELETED':
+                    known.pop(_object_key(obj), None)
+                else:
+                    known[_object_key(obj)] = obj
+                yield event['type'], obj
+
+                if stop is not None and stop.is_set():
+                    return
+        finally:
+            r.close()
+
+
+def _relist(api, url, namespace, version, known, params):
+    """Brings `known` in line with a fresh listing. Returns the events that
+    were missed and the listing's resourceVersion."""
+
+    r = api.get(url=url, namespace=namespace, version=version, params=params)
+    api.raise_for_status(r)
+    listing = r.json()
+
+    listed = {}
+    for obj in listing['items']:
+        # list items come without a kind, watch events have one
+        obj.setdefault('kind', listing.get('kind', '')[:-len('List')])
+        listed[_object_key(obj)] = obj
+
+    events = []
+    for key in sorted(set(known) - set(listed)):
+        events.append(('DELETED', known.pop(key)))
+    for key, obj in sorted(listed.items()):
+        previous = known.get(key)
+        if previous is None:
+            events.append(('ADDED', obj))
+        elif previous['metadata'].get('resourceVersion') != \
+                obj['metadata'].get('resourceVersion'):
+            events.append(('MODIFIED', obj))
+        known[key] = obj
+
+    return events, listing['metadata']['resourceVersion']
+
+
+def _object_key(obj):
+    return obj['metadata'].get('namespace'), obj['metadata']['name']
+
+
+def wait_until_gone(api, url, deadline, namespace=None, version='v1',
+                    **params):
+    """Waits, through a watch, until no object matches `params` any more.
+    Returns False if some are still around at `deadline`."""
+
+    r = api.get(url=url, namespace=namespace, version=version, params=params)
+    api.raise_for_status(r)
+    listing = r.json()
+
+    remaining = set(o['metadata']['name'] for o in listing['items'])
+    if not remaining:
+        return True
+
+    for event_type, obj in watch(
+            api, url, namespace=namespace, version=version,
+            resource_version=listing['metadata']['resourceVersion'],
+            deadline=deadline, items=listing['items'], **params):
+        if event_type == 'DELETED':
+            remaining.discard(obj['metadata']['name'])
+        else:
+            remaining.add(obj['metadata']['name'])
+
+        if not remaining:
+            return True
+
+    return False
+
+
+def classify_pod(obj):
+    """Classifies a pod from its last known state, without sleeping or
+    talking to the server. Returns (phase, error, transient), `transient`
+    being set while a container is still being created or has restarted,
+    i.e. while the pod deserves another look later on."""
+
+    status = obj.get('status') or {}
+    for condition in status.get('conditions') or []:
+        if condition['type'] == 'Ready' and condition['status'] == 'True':
+            return POD_RUNNING, None, False
+
+    transient = False
+    for container_status in status.get('containerStatuses') or []:
+        waiting = container_status['state'].get('waiting')
+        if waiting:
+            reason = waiting.get('reason')
+            if reason in CONTAINER_ERROR_STATES:
+                return POD_FAILED, waiting.get('message') or reason, False
+            elif reason == 'ContainerCreating':
+                transient = True
+
+        restart_count = container_status.get('restartCount', 0)
+        if restart_count > MAX_RESTARTS:
+            return POD_FAILED, "Container restarting more than allowed: %s" % \
+                container_status['name'], False
+        elif restart_count > 0:
+            transient = True
+
+    return POD_NOT_READY, None, transient
+
+
+class _Backoff(object):
+    """Re-check schedule shared by every pod being followed. Each key gets
+    an exponentially growing delay while it keeps being scheduled, and
+    starts over once reset."""
+
+    def __init__(self, initial=1, maximum=16):
+        self.initial, self.maximum = initial, maximum
+        self._delays, self._due, self._heap = {}, {}, []
+
+    def schedule(self, key):
+        if key in self._due:
+            return
+        delay = self._delays.get(key, self.initial)
+        self._delays[key] = min(delay * 2, self.maximum)
+        self._due[key] = time.time() + delay
+        heapq.heappush(self._heap, (self._due[key], key))
+
+    def reset(self, key):
+        self._delays.pop(key, None)
+        self._due.pop(key, None)
+
+    def next_due(self):
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        keys = []
+        while self.next_due() is not None and self.next_due() <= now:
+            _, key = heapq.heappop(self._heap)
+            del self._due[key]
+            keys.append(key)
+        return keys
+
+
+def check_rollouts(deployments, timeout=ROLLOUT_TIMEOUT):
+    """Follows the rollout of all `deployments` at once: their pods and the
+    deployments themselves are watched, every event lands in one loop that
+    classifies pods as they change. Pods stuck creating or restarting are
+    re-read on a single backoff schedule rather than waited on one after
+    the other. Returns a (failing_pods, status) pair per deployment."""
+
+    deadline = time.time() + timeout
+    events, stop = queue.Queue(), threading.Event()
+    backoff = _Backoff()
+    phases  = [{} for _ in deployments]
+    results = [None] * len(deployments)
+
+    def update_pod(i, obj):
+        pod = Pod(deployments[i].api, obj)
+        phase, error, transient = classify_pod(obj)
+
+        previous = phases[i].get(pod.name)
+        if previous is None or previous[1] != phase:
+            click.echo("pod %s: phase: %s error: %s" % (pod, phase, error))
+        phases[i][pod.name] = (pod, phase)
+
+        if transient:
+            backoff.schedule((i, pod.name))
         else:
-            if 'containerStatuses' in self.obj['status']:
-                for container_status in self.obj['status']['containerStatuses']:
-                    state = container_status['state']
-
-                    if 'waiting' in state:
-                        reason = state['waiting']['reason']
-                        if reason in CONTAINER_ERROR_STATES:
-                            status = POD_FAILED
-                            error = state['waiting']['message']
-                        elif reason == 'containercreating':
-                            click.echo("{}: {}".format(
-                                container_status['name'],
-                                state['waiting']['message']
-                            ))
-                            time.sleep(back_off_timeout/2)
-
-                    restart_count = container_status.get('restartCount', -1)
-
-                    if restart_count > 3:
-                        click.echo(
-                            "Container restarting more than allowed: %s" %
-                            container_status['name']
-                        )
-                        status = POD_FAILED
-                    elif restart_count > 0:
-                        click.echo("Container restarting : %s waiting for %s seconds before checking again" % (
-                            container_status['name'], back_off_timeout))
-                        time.sleep(back_off_timeout)
+            backoff.reset((i, pod.name))
+
+    def list_pods(i):
+        dp = deployments[i]
+        r = dp.api.get(url='pods', namespace=dp.namespace,
+                       params={'labelSelector': dp.pod_selector})
+        dp.api.raise_for_status(r)
+        listing = r.json()
+
+        names = set()
+        for obj in listing['items']:
+            names.add(obj['metadata']['name'])
+            update_pod(i, obj)
+        for name in set(phases[i]) - names:
+            del phases[i][name]
+            backoff.reset((i, name))
+
+        return listing
+
+    try:
+        for i, dp in enumerate(deployments):
+            dp.reload()
+            listing = list_pods(i)
+            _start_watch(events, stop, dp.api, 'pods', tag=i,
+                         namespace=dp.namespace,
+                         resource_version=listing['metadata']['resourceVersion'],
+                         items=listing['items'],
+                         deadline=deadline,
+                         labelSelector=dp.pod_selector)
+            _start_watch(events, stop, dp.api, 'deployments', tag=i,
+                         namespace=dp.namespace,
+                         version=dp.version,
+                         resource_version=dp.obj['metadata']['resourceVersion'],
+                         items=[dp.obj],
+                         deadline=deadline,
+                         fieldSelector='metadata.name=%s' % dp.name)
+
+        while True:
+            for i, dp in enumerate(deployments):
+                if results[i] is None:
+                    failing_pods, status = dp._rollout_status(phases[i])
+                    if status != PHASE_UNKNOWN:
+                        results[i] = (failing_pods, status)
+
+            pending = [i for i, result in enumerate(results) if result is None]
+            if not pending:
+                return results
+
+            now = time.time()
+            if now >= deadline:
+                for i in pending:
+                    click.echo("Timed out waiting for rollout of %s" %
+                               deployments[i])
+                    results[i] = ([], PHASE_FAILED)
+                return results
+
+            wake_up = min(deadline, backoff.next_due() or deadline)
+            try:
+                i, event_type, obj = events.get(timeout=max(0, wake_up - now))
+            except queue.Empty:
+                event_type = None
+
+            if event_type == 'ERROR':
+                raise obj
+            elif event_type is None or results[i] is not None:
+                pass
+            elif obj['kind'] == 'Deployment':
+                deployments[i].obj = obj
+            elif event_type == 'DELETED':
+                phases[i].pop(obj['metadata']['name'], None)
+                backoff.reset((i, obj['metadata']['name']))
             else:
-                click.echo("No status for %s" % self.name)
+                update_pod(i, obj)
+
+            # one listing per deployment covers all of its pods that are due
+            for i in sorted(set(i for i, _ in backoff.pop_due(time.time()))):
+                if results[i] is None:
+                    list_pods(i)
+    finally:
+        stop.set()
+
+
+def print_logs(pods, jobs=LOG_WORKERS, containers=None, **options):
+    """Streams the logs of the failing containers of `pods` (only those
+    named in `containers` when given) on `jobs` threads, every line
+    prefixed with its pod and container. `options` are passed on to
+    Pod.stream_logs and should bound how much is fetched."""
+
+    targets = []
+    for pod in pods:
+        for name, previous in pod.failing_containers():
+            if not containers or name in containers:
+                targets.append((pod, name, previous))
+    if not targets:
+        return
+
+    lock  = threading.Lock()
+    width = max(len('%s/%s' % (pod.name, name)) for pod, name, _ in targets)
+
+    def emit(prefix, line):
+        with lock:
+            click.secho("%s | %s" % (prefix.ljust(width), line), fg='red')
+
+    def fetch(target):
+        pod, name, previous = target
+        prefix, partial = '%s/%s' % (pod.name, name), u''
+        try:
+            for chunk in pod.stream_logs(name, previous=previous, **options):
+                lines = (partial + chunk).split(u'\n')
+                partial = lines.pop()
+                for line in lines:
+                    emit(prefix, line)
+            if partial:
+                emit(prefix, partial)
+        except Exception as e:
+            emit(prefix, "fetching logs failed: %s" % e)
+
+    pool = ThreadPool(max(1, jobs))
+    try:
+        pool.map(fetch, targets)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _start_watch(events, stop, api, url, tag=None, **kwargs):
+    def run():
+        try:
+            for event_type, obj in watch(api, url, stop=stop, **kwargs):
+                events.put((tag, event_type, obj))
+        except Exception as e:
+            events.put((tag, 'ERROR', e))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _label_selector(labels):
+    return ','.join('%s=%s' % (k, v) for k, v in sorted(labels.items()))
+
+
+def _entity_class(kind):
+    entity = globals().get(kind)
+    if isinstance(entity, type) and issubclass(entity, pykube.objects.APIObject):
+        return entity
+    return getattr(pykube, kind)
 
-        return status, error
 
 def _get_deployment_revision(obj):
-    annotations = obj['metadata']['annotations']
+    annotations = obj['metadata'].get('annotations') or {}
     return annotations.get('rzd/revision')
@@ -0,0 +1,288 @@
+import base64
+import difflib
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import time
+import yaml
+
+from rz import apply, manifest
+
+LEDGER_LABEL    = 'rzd/ledger'
+REVISION_LABEL  = 'rzd/revision'
+STATUS_KEY      = 'rzd/status'
+CREATED_KEY     = 'rzd/created-at'
+OBJECTS_KEY     = 'rzd/objects'
+ROLLBACK_OF_KEY = 'rzd/rollback-of'
+
+SECRET_TYPE = 'rzd/revision'
+DATA_KEY    = 'manifest.jsonl.gz'
+# what the api server accepts for a single secret
+MAX_SIZE    = 1024 * 1024
+
+# lists only need the labels and annotations, ask for metadata only and
+# take the full secrets from servers that can't do that (before 1.15)
+METADATA_ONLY = 'application/json;as=PartialObjectMetadataList;' \
+                'g=meta.k8s.io;v=v1,application/json'
+
+# how many revisions to keep, besides the last deployed one
+KEEP_REVISIONS = 10
+
+STATUS_APPLIED  = 'applied'
+STATUS_DEPLOYED = 'deployed'
+STATUS_FAILED   = 'failed'
+
+LEDGER_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rz',
+                                'ledger')
+
+
+class Revision(object):
+
+    def __init__(self, secret):
+        metadata    = secret['metadata']
+        annotations = metadata.get('annotations') or {}
+
+        self.name        = metadata['name']
+        self.number      = int(metadata['labels'][REVISION_LABEL])
+        self.status      = annotations.get(STATUS_KEY)
+        self.created     = annotations.get(CREATED_KEY)
+        self.objects     = int(annotations.get(OBJECTS_KEY, 0))
+        self.rollback_of = annotations.get(ROLLBACK_OF_KEY)
+
+    def __repr__(self):
+        return "<Revision %d: %s>" % (self.number, self.status)
+
+
+class Ledger(object):
+    """Every set of objects rzd applied to an app instance, one gzip
+    compressed Secret per revision in the app's namespace. Revisions are
+    listed by their metadata once, manifests are only fetched by load().
+    Recorded revisions never change (except for their status), so their
+    manifests are also kept on disk under `cache_dir` and only fetched once.
+    prune() drops all but the newest `keep` revisions, 0 keeps them all."""
+
+    def __init__(self, api, namespace=None, instance=None,
+                 cache_dir=LEDGER_CACHE_DIR, keep=KEEP_REVISIONS):
+        self.api       = api
+        self.namespace = namespace or 'default'
+        self.instance  = instance
+        self.keep      = keep
+        self._revisions = None
+
+        self.prefix = 'rzd.%s' % re.sub(r'[^a-z0-9.-]+', '-',
+                                        (instance or 'default').lower())
+        self.selector = '%s=true,%s' % (LEDGER_LABEL, apply.managed_selector(
+            instance))
+        if not instance:
+            self.selector += ',!%s' % apply.INSTANCE_LABEL
+
+        scope = '%s|%s|%s' % (api.url, self.namespace, self.prefix)
+        self.cache_dir = os.path.join(
+            cache_dir, hashlib.sha1(scope.encode('utf-8')).hexdigest()[:16])
+
+    def revisions(self, refresh=False):
+        """Recorded revisions, oldest first. The ledger's secrets are listed
+        (metadata only) the first time, or with `refresh`, and kept up to
+        date with what this ledger records afterwards."""
+
+        if self._revisions is None or refresh:
+            r = self.api.get(url='secrets', namespace=self.namespace,
+                             params={'labelSelector': self.selector},
+                             headers={'Accept': METADATA_ONLY})
+            self.api.raise_for_status(r)
+            self._revisions = sorted(
+                (Revision(secret) for secret in r.json()['items']),
+                key=lambda revision: revision.number)
+
+        return list(self._revisions)
+
+    def latest(self):
+        revisions = self.revisions()
+        return revisions[-1].number if revisions else None
+
+    def record(self, revision, objects, status=STATUS_APPLIED,
+               rollback_of=None):
+        payload = encode(objects)
+        if len(payload) * 4 / 3 > MAX_SIZE:
+            raise ValueError("revision %d is too large for the ledger "
+                             "(%d bytes compressed)" % (revision, len(payload)))
+
+        annotations = {
+            STATUS_KEY:  status,
+            CREATED_KEY: time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            OBJECTS_KEY: str(len(objects)),
+        }
+        if rollback_of is not None:
+            annotations[ROLLBACK_OF_KEY] = str(rollback_of)
+
+        labels = {LEDGER_LABEL: 'true', REVISION_LABEL: str(revision)}
+        labels.update(apply.managed_labels(self.instance))
+        if not self.instance:
+            del labels[apply.INSTANCE_LABEL]
+
+        secret = {
+            'kind': 'Secret',
+            'apiVersion': 'v1',
+            'type': SECRET_TYPE,
+            'metadata': {
+                'name': self._name(revision),
+                'namespace': self.namespace,
+                'labels': labels,
+                'annotations': annotations,
+            },
+            'data': {DATA_KEY: base64.b64encode(payload).decode('ascii')},
+        }
+
+        r = self.api.post(url='secrets', namespace=self.namespace,
+                          data=json.dumps(secret))
+        self.api.raise_for_status(r)
+        self._cache(revision, payload)
+
+        if self._revisions is not None:
+            self._revisions = sorted(
+                [rev for rev in self._revisions if rev.number != revision] +
+                [Revision(secret)], key=lambda rev: rev.number)
+
+    def set_status(self, revision, status):
+        patch = {'metadata': {'annotations': {STATUS_KEY: status}}}
+        r = self.api.patch(
+            url='secrets/%s' % self._name(revision),
+            namespace=self.namespace,
+            data=json.dumps(patch),
+            headers={'Content-Type': 'application/merge-patch+json'})
+        self.api.raise_for_status(r)
+
+        for rev in self._revisions or []:
+            if rev.number == revision:
+                rev.status = status
+
+    def prune(self):
+        """Deletes the oldest revisions beyond the newest `keep`, but never
+        the last deployed one, which a rollback goes back to. Returns the
+        deleted revision numbers."""
+
+        revisions = self.revisions()
+        if not self.keep or len(revisions) <= self.keep:
+            return []
+
+        deployed = [rev.number for rev in revisions
+                    if rev.status == STATUS_DEPLOYED]
+        deleted = []
+        for rev in revisions[:-self.keep]:
+            if deployed and rev.number == deployed[-1]:
+                continue
+
+            r = self.api.delete(url='secrets/%s' % rev.name,
+                                namespace=self.namespace)
+            if r.status_code != 404:
+                self.api.raise_for_status(r)
+            try:
+                os.remove(self._path(rev.number))
+            except OSError:
+                pass
+            deleted.append(rev.number)
+
+        self._revisions = [rev for rev in self._revisions
+                           if rev.number not in deleted]
+        return deleted
+
+    def load(self, revision):
+        """The objects recorded for `revision`, from the local cache when
+        possible."""
+
+        try:
+            with open(self._path(revision), 'rb') as fp:
+                return decode(fp.read())
+        except (IOError, OSError):
+            pass
+
+        r = self.api.get(url='secrets/%s' % self._name(revision),
+                         namespace=self.namespace)
+        if r.status_code == 404:
+            raise KeyError("revision %d isn't in the ledger" % revision)
+        self.api.raise_for_status(r)
+
+        payload = _payload(r.json())
+        self._cache(revision, payload)
+        return decode(payload)
+
+    def _name(self, revision):
+        return '%s.v%d' % (self.prefix, revision)
+
+    def _path(self, revision):
+        return os.path.join(self.cache_dir, '%d.jsonl.gz' % revision)
+
+    def _cache(self, revision, payload):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+
+            # write then rename, so concurrent runs never read half a file
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(payload)
+            os.rename(tmp, self._path(revision))
+        except (IOError, OSError):
+            pass
+
+
+def encode(objects):
+    """Objects as gzip compressed JSON lines, byte for byte the same for the
+    same objects."""
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fp:
+        for obj in objects:
+            fp.write(json.dumps(obj, sort_keys=True,
+                                separators=(',', ':')).encode('utf-8'))
+            fp.write(b'\n')
+    return buf.getvalue()
+
+
+def decode(payload):
+    with gzip.GzipFile(fileobj=io.BytesIO(payload), mode='rb') as fp:
+        return [json.loads(line.decode('utf-8'))
+                for line in fp.read().splitlines() if line.strip()]
+
+
+def diff(old, new, old_label='a', new_label='b'):
+    """Unified diff, as lines, between two sets of objects rendered as YAML,
+    object by object. The annotations rzd adds are left out."""
+
+    def index(objects):
+        return dict(('%s/%s/%s' % (o['kind'],
+                                   o['metadata'].get('namespace', 'default'),
+                                   o['metadata']['name']), _render(o))
+                    for o in objects)
+
+    old, new = index(old), index(new)
+    lines = []
+    for key in sorted(set(old) | set(new)):
+        lines.extend(difflib.unified_diff(
+            old.get(key, []), new.get(key, []),
+            fromfile='%s/%s' % (old_label, key),
+            tofile='%s/%s' % (new_label, key),
+            lineterm=''))
+    return lines
+
+
+def _render(obj):
+    obj = dict(obj, metadata=dict(obj['metadata']))
+    annotations = dict(obj['metadata'].get('annotations') or {})
+    annotations.pop(apply.RZD_VERSION_KEY, None)
+    annotations.pop(apply.RZD_HASH_KEY, None)
+    if annotations:
+        obj['metadata']['annotations'] = annotations
+    else:
+        obj['metadata'].pop('annotations', None)
+
+    return yaml.dump(obj, Dumper=manifest.Dumper, default_flow_style=False,
+                     allow_unicode=True).splitlines()
+
+
+def _payload(secret):
+    return base64.b64decode(secret['data'][DATA_KEY])
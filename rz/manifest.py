@@ -0,0 +1,48 @@
+import json
+import yaml
+
+# libyaml's parser and emitter are several times faster, use them if PyYAML
+# was built with them
+Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+Dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+JSONL_EXTENSIONS = ('.jsonl', '.ndjson')
+
+
+def is_jsonl(path):
+    return path.endswith(JSONL_EXTENSIONS)
+
+
+def load(path):
+    """Yields the objects of a manifest one at a time, as they are parsed.
+    `.jsonl`/`.ndjson` files hold one JSON object per line, anything else is
+    read as a multi document YAML file."""
+
+    with open(path, 'r') as fp:
+        if is_jsonl(path):
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for obj in yaml.load_all(fp, Loader=Loader):
+                if obj is not None:
+                    yield obj
+
+
+def dump(objects, path):
+    """Writes `objects` (any iterable) to `path` one object at a time, in the
+    format its extension asks for."""
+
+    with open(path, 'w') as fp:
+        for i, obj in enumerate(objects):
+            if is_jsonl(path):
+                fp.write(json.dumps(obj, sort_keys=True,
+                                    separators=(',', ':')))
+                fp.write('\n')
+            else:
+                if i > 0:
+                    fp.write('---\n')
+                yaml.dump(obj, fp, Dumper=Dumper,
+                          default_flow_style=False,
+                          allow_unicode=True,
+                          encoding='utf-8')
@@ -0,0 +1,110 @@
+import click
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from six.moves import queue
+
+STAGE_OK        = 'ok'
+STAGE_FAILED    = 'failed'
+STAGE_CANCELLED = 'cancelled'
+
+
+class Stage(object):
+    """A step of a pipeline: `run(value)` gets what the previous stage
+    returned for an item and returns what the next one gets. At most
+    `workers` items go through it at a time."""
+
+    def __init__(self, name, run, workers=1):
+        self.name    = name
+        self.run     = run
+        self.workers = workers
+
+
+class PipelineResult(object):
+
+    def __init__(self, name):
+        self.name      = name
+        self.statuses  = {}
+        self.durations = {}
+        self.error     = None
+
+    @property
+    def ok(self):
+        return self.error is None and \
+            STAGE_CANCELLED not in self.statuses.values()
+
+    @property
+    def duration(self):
+        return sum(self.durations.values())
+
+    def __repr__(self):
+        return "<PipelineResult %s: %s>" % (self.name, self.statuses)
+
+
+def run(items, stages, names=None, keep_going=False):
+    """Moves every item through `stages`, each stage with its own pool of
+    workers. An item enters a stage as soon as it is done with the previous
+    one, whatever the other items are up to. Unless `keep_going` is set the
+    first failure cancels the items that haven't started a stage yet.
+    Returns a PipelineResult per item, `names` giving their names."""
+
+    names = names or [str(item) for item in items]
+    results = [PipelineResult(name) for name in names]
+    pools = [ThreadPool(max(1, stage.workers)) for stage in stages]
+    finished, failed = queue.Queue(), threading.Event()
+
+    def step(i, k, value):
+        result, stage = results[i], stages[k]
+        handed_on = False
+        try:
+            if failed.is_set() and not keep_going:
+                result.statuses[stage.name] = STAGE_CANCELLED
+                return
+
+            started = time.time()
+            try:
+                value = stage.run(value)
+                result.statuses[stage.name] = STAGE_OK
+            except Exception as e:
+                result.statuses[stage.name] = STAGE_FAILED
+                result.error = e
+                failed.set()
+            result.durations[stage.name] = time.time() - started
+
+            if result.error is None and k + 1 < len(stages):
+                pools[k + 1].apply_async(step, (i, k + 1, value))
+                handed_on = True
+        except BaseException as e:
+            result.statuses[stage.name] = STAGE_FAILED
+            result.error = result.error or e
+            failed.set()
+        finally:
+            # run() waits for every item, whatever happened to it
+            if not handed_on:
+                finished.put(i)
+
+    try:
+        for i, item in enumerate(items):
+            pools[0].apply_async(step, (i, 0, item))
+        for _ in items:
+            finished.get()
+    finally:
+        for pool in pools:
+            pool.close()
+            pool.join()
+
+    return results
+
+
+def print_summary(results, stages):
+    names = [stage.name for stage in stages]
+    click.echo("%-32s " % 'NAME' +
+               " ".join("%-10s" % name.upper() for name in names) +
+               " %8s" % 'TIME')
+    for r in results:
+        click.echo("%-32s " % r.name +
+                   " ".join("%-10s" % r.statuses.get(name, '-')
+                            for name in names) +
+                   " %7.2fs" % r.duration)
+        if r.error is not None:
+            click.secho("  -> %s" % r.error, fg='red')
@@ -0,0 +1,72 @@
+import re
+import requests
+
+MANIFEST_TYPES = ', '.join([
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.manifest.v1+json',
+])
+
+
+class Registry(object):
+    """Just enough of the docker registry v2 api to look images up, with
+    basic or bearer token auth."""
+
+    timeout = 30
+
+    def __init__(self, server, username=None, password=None):
+        self.server = re.sub(r'^https?://', '', server).rstrip('/')
+        self.url = server.rstrip('/') if '://' in server else \
+            'https://%s' % self.server
+        self.username, self.password = username, password
+        self.auth = (username, password) if username else None
+        self.session = requests.Session()
+        self._tokens = {}
+
+    def manifest_digest(self, repository, reference):
+        """Digest of `repository:reference`, None if the registry hasn't
+        got it."""
+
+        r = self._request('HEAD', repository,
+                          '/v2/%s/manifests/%s' % (repository, reference),
+                          headers={'Accept': MANIFEST_TYPES})
+        if r.status_code == 404:
+            return None
+
+        r.raise_for_status()
+        return r.headers.get('Docker-Content-Digest')
+
+    def has_image(self, repository, reference):
+        return self.manifest_digest(repository, reference) is not None
+
+    def _request(self, method, repository, path, headers=None, **kwargs):
+        headers = dict(headers or {})
+        token = self._tokens.get(repository)
+        if token:
+            headers['Authorization'] = 'Bearer %s' % token
+
+        r = self.session.request(method, self.url + path, headers=headers,
+                                 auth=None if token else self.auth,
+                                 timeout=self.timeout, **kwargs)
+
+        challenge = r.headers.get('WWW-Authenticate', '')
+        if r.status_code == 401 and challenge.startswith('Bearer'):
+            token = self._tokens[repository] = self._token(challenge,
+                                                           repository)
+            headers['Authorization'] = 'Bearer %s' % token
+            r = self.session.request(method, self.url + path, headers=headers,
+                                     timeout=self.timeout, **kwargs)
+
+        return r
+
+    def _token(self, challenge, repository):
+        params = dict(re.findall(r'(\w+)="([^"]*)"', challenge))
+        realm = params.pop('realm')
+        params.setdefault('scope', 'repository:%s:pull' % repository)
+
+        r = self.session.get(realm, params=params, auth=self.auth,
+                             timeout=self.timeout)
+        r.raise_for_status()
+
+        body = r.json()
+        return body.get('token') or body.get('access_token')
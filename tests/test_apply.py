@@ -0,0 +1,157 @@
+import json
+import unittest
+
+import pykube
+import requests
+
+from rz import apply
+
+
+def response(status_code, body):
+    r = requests.Response()
+    r.status_code = status_code
+    r.reason = 'Status %d' % status_code
+    r.url = 'https://kube/api'
+    r.headers['content-type'] = 'application/json'
+    r._content = json.dumps(body).encode('utf-8')
+    return r
+
+
+class FakeAPI(object):
+    """Answers like an api server that already has an unlabelled `web`
+    service, when `existing` is set."""
+
+    def __init__(self, existing):
+        self.existing = existing
+        self.patches  = []
+
+    def post(self, **kwargs):
+        if self.existing:
+            return response(409, {'kind': 'Status', 'code': 409,
+                                  'message': 'services "web" already exists'})
+        return response(201, json.loads(kwargs['data']))
+
+    def get(self, **kwargs):
+        if self.existing:
+            return response(200, SERVICE)
+        return response(404, {'kind': 'Status', 'code': 404,
+                              'message': 'services "web" not found'})
+
+    def patch(self, **kwargs):
+        self.patches.append(json.loads(kwargs['data']))
+        return response(200, json.loads(kwargs['data']))
+
+    def raise_for_status(self, r):
+        raise_for_status = pykube.HTTPClient.raise_for_status
+        getattr(raise_for_status, '__func__', raise_for_status)(self, r)
+
+
+class FakeClient(object):
+    """Client whose label scoped lookups find nothing."""
+
+    def __init__(self, api):
+        self.api = api
+
+    def get_by_name(self, kind, name, namespace=None):
+        return None
+
+    def object(self, _json):
+        return getattr(pykube, _json['kind'])(self.api, _json)
+
+
+SERVICE = {
+    'kind': 'Service',
+    'apiVersion': 'v1',
+    'metadata': {'name': 'web', 'namespace': 'default'},
+    'spec': {'ports': [{'port': 80}], 'selector': {'app': 'web'}},
+}
+
+
+def manifest_service():
+    _json = json.loads(json.dumps(SERVICE))
+    _json['metadata']['labels'] = apply.managed_labels('app')
+    return _json
+
+
+class ApplyObjectTest(unittest.TestCase):
+
+    def test_creates_missing_object(self):
+        api = FakeAPI(existing=False)
+        action = apply.apply_object(FakeClient(api), manifest_service(), 1)
+
+        self.assertEqual(action, apply.ACTION_CREATED)
+        self.assertEqual(api.patches, [])
+
+    def test_updates_legacy_unlabelled_object(self):
+        api = FakeAPI(existing=True)
+        action = apply.apply_object(FakeClient(api), manifest_service(), 1)
+
+        self.assertEqual(action, apply.ACTION_UPDATED)
+        self.assertEqual(len(api.patches), 1)
+        metadata = api.patches[0]['metadata']
+        self.assertEqual(metadata['labels'][apply.MANAGED_BY_LABEL],
+                         apply.MANAGED_BY)
+        self.assertEqual(metadata['annotations'][apply.RZD_VERSION_KEY], '1')
+
+    def test_create_error_is_raised_when_object_is_missing(self):
+        api = FakeAPI(existing=False)
+        api.post = lambda **kwargs: response(
+            422, {'kind': 'Status', 'code': 422, 'message': 'invalid'})
+
+        with self.assertRaises(pykube.exceptions.HTTPError):
+            apply.apply_object(FakeClient(api), manifest_service(), 1)
+
+
+class LiveClient(FakeClient):
+    """Client that finds `live` through its label scoped lookups."""
+
+    def __init__(self, api, live):
+        FakeClient.__init__(self, api)
+        self.live = live
+
+    def get_by_name(self, kind, name, namespace=None):
+        return pykube.Service(self.api, json.loads(json.dumps(self.live)))
+
+
+def deployed(_json, **spec):
+    """`_json` as the server hands it back after rzd applied it."""
+    live = json.loads(json.dumps(_json))
+    live['metadata']['annotations'] = {
+        apply.RZD_VERSION_KEY: '1',
+        apply.RZD_HASH_KEY: apply.content_hash(_json),
+    }
+    live['metadata']['uid'] = 'f00'
+    live['spec'].update(spec, clusterIP='10.0.0.1')
+    return live
+
+
+class SkipUnchangedTest(unittest.TestCase):
+
+    def test_skips_object_matching_manifest(self):
+        api = FakeAPI(existing=True)
+        client = LiveClient(api, deployed(manifest_service()))
+
+        action = apply.apply_object(client, manifest_service(), 2)
+        self.assertEqual(action, apply.ACTION_SKIPPED)
+        self.assertEqual(api.patches, [])
+
+    def test_updates_object_edited_in_place(self):
+        # kubectl edit keeps rzd's annotations but changes the spec
+        api = FakeAPI(existing=True)
+        live = deployed(manifest_service(), selector={'app': 'other'})
+
+        action = apply.apply_object(LiveClient(api, live),
+                                    manifest_service(), 2)
+        self.assertEqual(action, apply.ACTION_UPDATED)
+        self.assertEqual(api.patches[0]['spec']['selector'], {'app': 'web'})
+
+    def test_force_updates_unchanged_object(self):
+        api = FakeAPI(existing=True)
+        client = LiveClient(api, deployed(manifest_service()))
+
+        action = apply.apply_object(client, manifest_service(), 2, force=True)
+        self.assertEqual(action, apply.ACTION_UPDATED)
+
+
+if __name__ == '__main__':
+    unittest.main()
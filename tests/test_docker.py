@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from rz import docker, engine
+
+
+class PrefixedTest(unittest.TestCase):
+
+    def test_prefixes_every_line(self):
+        echo = docker._prefixed('web', 6, threading.Lock())
+        with mock.patch.object(docker.click, 'echo') as click_echo:
+            echo('Step 1/2\nStep 2/2')
+
+        self.assertEqual([c[0][0] for c in click_echo.call_args_list],
+                         [u'web    | Step 1/2', u'web    | Step 2/2'])
+
+    def test_non_ascii_output(self):
+        echo = docker._prefixed('web', 3, threading.Lock())
+        with mock.patch.object(docker.click, 'echo') as click_echo:
+            echo(u'caf\xe9')
+            echo(u'na\xefve'.encode('utf-8'))
+
+        self.assertEqual([c[0][0] for c in click_echo.call_args_list],
+                         [u'web | caf\xe9', u'web | na\xefve'])
+
+
+class FakeEngine(object):
+    """Engine with the images in `local`, which can pull those in
+    `remote`."""
+
+    def __init__(self, local=None, remote=None):
+        self.local  = dict(local or {})
+        self.remote = dict(remote or {})
+        self.pulled, self.built, self.tagged = [], [], []
+
+    def version(self):
+        return {}
+
+    def image_id(self, name):
+        if ':' not in name.rsplit('/', 1)[-1]:
+            name += ':latest'
+        return self.local.get(name)
+
+    def pull(self, image, echo=None):
+        self.pulled.append(image)
+        if image + ':latest' not in self.remote:
+            raise engine.EngineError("manifest for %s not found" % image)
+        self.local[image + ':latest'] = self.remote[image + ':latest']
+
+    def build(self, context, tag, **kwargs):
+        self.built.append(tag)
+        self.local[tag] = 'sha256:built'
+
+    def tag(self, image, target):
+        self.tagged.append(target)
+        self.local[target] = self.local[image]
+
+
+class BuildDigestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.context)
+        with open(os.path.join(self.context, 'Dockerfile'), 'w') as fp:
+            fp.write('FROM python\nCOPY . /app\n')
+        self.req = {'context': self.context, 'tag': 'web:latest'}
+
+    def digest(self, docker_engine):
+        with mock.patch.object(engine, 'default_engine',
+                               lambda: docker_engine):
+            return docker.build_digest(self.req, echo=lambda message: None)
+
+    def test_missing_base_image_is_pulled(self):
+        fresh = FakeEngine(remote={'python:latest': 'sha256:py1'})
+        warm = FakeEngine(local={'python:latest': 'sha256:py1'})
+
+        self.assertEqual(self.digest(fresh), self.digest(warm))
+        self.assertEqual(fresh.pulled, ['python'])
+        self.assertEqual(warm.pulled, [])
+
+        newer = FakeEngine(local={'python:latest': 'sha256:py2'})
+        self.assertNotEqual(self.digest(newer), self.digest(warm))
+
+    def test_unresolved_base_image_skips_the_cache(self):
+        docker_engine = FakeEngine()
+        self.assertIsNone(self.digest(docker_engine))
+
+        with mock.patch.object(engine, 'default_engine',
+                               lambda: docker_engine):
+            status, tags = docker.build_cached(
+                self.req, echo=lambda message: None, aliases=['worker'])
+
+        self.assertEqual(status, docker.BUILD_OK)
+        self.assertEqual(tags, [['web:latest'], ['worker']])
+        self.assertEqual(docker_engine.built, ['web:latest'])
+        self.assertEqual(docker_engine.tagged, ['worker'])
+
+
+if __name__ == '__main__':
+    unittest.main()
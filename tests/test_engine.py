@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+import distutils.spawn
+import json
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs
+
+from rz import engine
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn,
+                     socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TLSHTTPServer(socketserver.ThreadingMixIn,
+                    BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def shutdown_request(self, request):
+        # say goodbye like dockerd does, the client sees a truncated
+        # response otherwise
+        try:
+            request.unwrap()
+        except (ssl.SSLError, socket.error):
+            pass
+        self.close_request(request)
+
+
+def make_certs(path):
+    """A CA, a server certificate for localhost and a client certificate
+    laid out like DOCKER_CERT_PATH, plus the server's in server-*.pem."""
+
+    def openssl(*args):
+        subprocess.check_call(('openssl',) + args, cwd=path,
+                              stdout=open(os.devnull, 'w'),
+                              stderr=subprocess.STDOUT)
+
+    with open(os.path.join(path, 'server.ext'), 'w') as fp:
+        fp.write('subjectAltName=DNS:localhost,IP:127.0.0.1\n')
+    with open(os.path.join(path, 'client.ext'), 'w') as fp:
+        fp.write('extendedKeyUsage=clientAuth\n')
+
+    openssl('req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=test ca', '-keyout', 'ca-key.pem', '-out', 'ca.pem')
+    for name, key, cert in [('server', 'server-key.pem', 'server-cert.pem'),
+                            ('client', 'key.pem', 'cert.pem')]:
+        openssl('req', '-newkey', 'rsa:2048', '-nodes', '-subj',
+                '/CN=localhost', '-keyout', key, '-out', name + '.csr')
+        openssl('x509', '-req', '-days', '1', '-in', name + '.csr',
+                '-CA', 'ca.pem', '-CAkey', 'ca-key.pem', '-CAcreateserial',
+                '-extfile', name + '.ext', '-out', cert)
+
+
+class FakeDaemon(object):
+    """Docker daemon stand-in on a unix socket, or with `tls` on a TLS
+    port of localhost requiring a client certificate. `routes` map (method,
+    path) to (status, body), a list body being sent as separate writes."""
+
+    def __init__(self, routes, tls=False):
+        self.routes, self.requests = routes, []
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'docker.sock')
+        daemon = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.0'
+
+            def respond(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                daemon.requests.append((self.command, url.path,
+                                        parse_qs(url.query),
+                                        dict(self.headers.items()),
+                                        self.rfile.read(length)))
+
+                status, body = daemon.routes.get(
+                    (self.command, url.path.split('/', 2)[-1]),
+                    (404, {'message': 'no such route'}))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                for chunk in body if isinstance(body, list) else [body]:
+                    if not isinstance(chunk, bytes):
+                        chunk = json.dumps(chunk).encode('utf-8')
+                    self.wfile.write(chunk)
+                    self.wfile.flush()
+
+            do_GET = do_POST = respond
+
+            def address_string(self):
+                return 'unix'
+
+            def log_message(self, *args):
+                pass
+
+        if tls:
+            make_certs(self.dir)
+            self.server = TLSHTTPServer(('127.0.0.1', 0), Handler)
+            self.server.socket = ssl.wrap_socket(
+                self.server.socket, server_side=True,
+                certfile=os.path.join(self.dir, 'server-cert.pem'),
+                keyfile=os.path.join(self.dir, 'server-key.pem'),
+                ca_certs=os.path.join(self.dir, 'ca.pem'),
+                cert_reqs=ssl.CERT_REQUIRED)
+            self.host = 'tcp://localhost:%d' % self.server.server_address[1]
+        else:
+            self.server = UnixHTTPServer(self.path, Handler)
+            self.host = 'unix://' + self.path
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def engine(self):
+        return engine.Engine(self.host)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+
+class EngineTest(unittest.TestCase):
+
+    def daemon(self, routes, **kwargs):
+        daemon = FakeDaemon(routes, **kwargs)
+        self.addCleanup(daemon.close)
+        return daemon
+
+    def test_version(self):
+        daemon = self.daemon({('GET', 'version'): (200, {'Version': '1.13'})})
+        self.assertEqual(daemon.engine().version(), {'Version': '1.13'})
+
+    @unittest.skipUnless(distutils.spawn.find_executable('openssl'),
+                         "needs openssl to make certificates")
+    def test_tls_daemon(self):
+        daemon = self.daemon({('GET', 'version'): (200, {'Version': '1.13'})},
+                             tls=True)
+
+        env = {'DOCKER_HOST': daemon.host, 'DOCKER_TLS_VERIFY': '1',
+               'DOCKER_CERT_PATH': daemon.dir}
+        with mock.patch.dict(os.environ, env):
+            self.assertEqual(engine.Engine().version(), {'Version': '1.13'})
+
+        # without the client certificate the daemon hangs up
+        with mock.patch.dict(os.environ, env):
+            os.environ.pop('DOCKER_TLS_VERIFY')
+            self.assertRaises(engine.EngineError, engine.Engine().version)
+
+    def test_image_inventory_is_fetched_once(self):
+        daemon = self.daemon({('GET', 'images/json'): (200, [[
+            {'Id': 'sha256:aaa', 'RepoTags': ['web:latest', 'web:rz-1']},
+            {'Id': 'sha256:bbb', 'RepoTags': ['shaarli:latest']},
+        ]])})
+        docker = daemon.engine()
+
+        self.assertEqual(docker.image_id('web'), 'sha256:aaa')
+        self.assertEqual(docker.image_id('web:rz-1'), 'sha256:aaa')
+        self.assertEqual(docker.image_id('shaarli'), 'sha256:bbb')
+        self.assertEqual(docker.image_id('sha256:bbb'), 'sha256:bbb')
+        self.assertIsNone(docker.image_id('db'))
+        self.assertEqual(len(daemon.requests), 1)
+
+    def test_errors_carry_daemon_message(self):
+        daemon = self.daemon({('GET', 'images/web/json'):
+                              (404, {'message': 'No such image: web'})})
+        with self.assertRaises(engine.EngineError) as ctx:
+            daemon.engine().inspect('web')
+        self.assertIn('No such image: web', str(ctx.exception))
+
+    def test_stream_error_message_raises(self):
+        daemon = self.daemon({('POST', 'images/create'): (200, [
+            {'status': 'Pulling from library/web'},
+            {'error': 'manifest unknown'},
+        ])})
+        with self.assertRaises(engine.EngineError) as ctx:
+            daemon.engine().pull('web:1')
+        self.assertEqual(str(ctx.exception), 'manifest unknown')
+
+    def test_stream_decodes_utf8_split_across_reads(self):
+        message = json.dumps({'stream': u'caf\xe9\n'},
+                             ensure_ascii=False).encode('utf-8')
+        cut = message.index(b'\xc3') + 1
+        daemon = self.daemon({('POST', 'build'): (200, [
+            message[:cut], message[cut:] + b'\n',
+            {'aux': {'ID': 'sha256:ccc'}},
+        ])})
+
+        lines = []
+        build = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, build)
+        with open(os.path.join(build, 'Dockerfile'), 'w') as fp:
+            fp.write('FROM scratch\n')
+
+        docker = daemon.engine()
+        self.assertEqual(docker.build(build, 'web:1', echo=lines.append),
+                         'sha256:ccc')
+        self.assertEqual(lines, [u'caf\xe9'])
+
+        method, path, params, headers, body = daemon.requests[0]
+        self.assertEqual(params['t'], ['web:1'])
+        self.assertEqual(headers['content-type'], 'application/x-tar')
+        self.assertEqual(int(headers['content-length']), len(body))
+
+    def test_push_reports_uploaded_bytes_and_sends_auth(self):
+        daemon = self.daemon({
+            ('POST', 'auth'): (200, {'Status': 'Login Succeeded'}),
+            ('POST', 'images/registry.io/web/push'): (200, [
+                {'status': 'Pushing', 'id': 'l1',
+                 'progressDetail': {'current': 10, 'total': 30}},
+                {'status': 'Pushing', 'id': 'l1',
+                 'progressDetail': {'current': 30, 'total': 30}},
+                {'status': 'Pushing', 'id': 'l2',
+                 'progressDetail': {'current': 5, 'total': 5}},
+                {'aux': {'Digest': 'sha256:ddd', 'Size': 1234}},
+            ]),
+        })
+        docker = daemon.engine()
+        docker.login('https://registry.io', 'user', 'secret')
+        self.assertTrue(docker.logged_in('registry.io'))
+
+        result = docker.push('registry.io/web:1')
+        self.assertEqual(result['Digest'], 'sha256:ddd')
+        self.assertEqual(result['Uploaded'], 35)
+
+        method, path, params, headers, body = daemon.requests[-1]
+        self.assertEqual(params['tag'], ['1'])
+        self.assertIn('x-registry-auth', headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,282 @@
+import gzip
+import io
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import httplib2
+import mock
+from googleapiclient.errors import HttpError
+
+from rz import gce
+
+
+def write(root, relpath, content):
+    path = os.path.join(root, relpath)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fp:
+        fp.write(content)
+
+
+def tree(root):
+    write(root, 'docker-compose.yml', b'version: "2"\n')
+    write(root, '.dockerignore', b'services/*\nDockerfile\n')
+    write(root, '.gcloudignore', b'*.log\n')
+    write(root, '.git/HEAD', b'ref: refs/heads/master\n')
+    write(root, 'debug.log', b'noise\n')
+    write(root, 'Dockerfile', b'FROM scratch\n')
+    write(root, 'services/web/Dockerfile', b'FROM python\n')
+    write(root, 'services/web/app.py', os.urandom(300 * 1024))
+    write(root, 'services/worker/run.sh', b'#!/bin/sh\n')
+    os.chmod(os.path.join(root, 'services/worker/run.sh'), 0o775)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.roots = []
+
+    def tearDown(self):
+        for root in self.roots:
+            shutil.rmtree(root)
+
+    def archive(self, root, **kwargs):
+        _, archive = gce.archive_codebase(root, 'project',
+                                          echo=lambda message: None,
+                                          **kwargs)
+        self.addCleanup(os.remove, archive.name)
+        with open(archive.name, 'rb') as fp:
+            return fp.read()
+
+    def checkout(self):
+        root = tempfile.mkdtemp()
+        self.roots.append(root)
+        tree(root)
+        return root
+
+    def test_equal_trees_give_equal_archives(self):
+        first, second = self.checkout(), self.checkout()
+        shutil.copy(os.path.join(first, 'services/web/app.py'),
+                    os.path.join(second, 'services/web/app.py'))
+        os.utime(os.path.join(second, 'Dockerfile'), (0, 0))
+
+        with mock.patch.object(gce, 'GZIP_BLOCK_SIZE', 64 * 1024):
+            self.assertEqual(self.archive(first, workers=4),
+                             self.archive(second, workers=1))
+
+    def test_archive_content(self):
+        root = self.checkout()
+        with mock.patch.object(gce, 'GZIP_BLOCK_SIZE', 64 * 1024):
+            data = self.archive(root)
+
+        # one gzip member per block, which plain gunzip reads as one stream
+        raw = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        tar = tarfile.open(fileobj=io.BytesIO(raw))
+        members = dict((m.name, m) for m in tar.getmembers())
+
+        # .git and .gcloudignore patterns are out, .dockerignore isn't
+        # applied to the shared archive
+        self.assertEqual(sorted(members), [
+            '.dockerignore', '.gcloudignore', 'Dockerfile',
+            'docker-compose.yml', 'services/web/Dockerfile',
+            'services/web/app.py', 'services/worker/run.sh'])
+
+        with open(os.path.join(root, 'services/web/app.py'), 'rb') as fp:
+            self.assertEqual(tar.extractfile('services/web/app.py').read(),
+                             fp.read())
+
+        run_sh = members['services/worker/run.sh']
+        self.assertEqual(run_sh.mode, 0o755)
+        self.assertEqual(run_sh.mtime, gce.ARCHIVE_MTIME)
+        self.assertEqual((run_sh.uid, run_sh.uname), (0, ''))
+        self.assertEqual(members['Dockerfile'].mode, 0o644)
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'')
+
+
+class FakeRequest(object):
+
+    def __init__(self, func):
+        self.func = func
+
+    def execute(self, http=None):
+        return self.func()
+
+    def next_chunk(self, http=None):
+        return None, self.func()
+
+
+class FakeGCS(object):
+    """Just enough of the storage api's discovery service, objects kept in
+    memory. Inserting a name in `broken` fails with a 403."""
+
+    def __init__(self, buckets=()):
+        self.buckets_ = set(buckets)
+        self.blobs    = {}
+        self.broken   = set()
+        self.composed = []
+
+    def buckets(self):
+        return self
+
+    def objects(self):
+        return self
+
+    def get(self, bucket, object=None):
+        def get():
+            if bucket not in self.buckets_:
+                raise http_error(404)
+            if object is None:
+                return {'name': bucket}
+            if object not in self.blobs:
+                raise http_error(404)
+            return {'name': object}
+        return FakeRequest(get)
+
+    def insert(self, project=None, body=None, bucket=None, name=None,
+               media_body=None):
+        def insert():
+            if media_body is None:
+                self.buckets_.add(body['name'])
+                return body
+            if name in self.broken:
+                raise http_error(403)
+            self.blobs[name] = media_body.getbytes(0, media_body.size())
+            return {'name': name}
+        return FakeRequest(insert)
+
+    def compose(self, destinationBucket, destinationObject, body):
+        def compose():
+            sources = [s['name'] for s in body['sourceObjects']]
+            assert len(sources) <= gce.COMPOSE_LIMIT
+            self.composed.append((destinationObject, sources))
+            self.blobs[destinationObject] = b''.join(self.blobs[name]
+                                                     for name in sources)
+            return {'name': destinationObject}
+        return FakeRequest(compose)
+
+    def delete(self, bucket, object):
+        def delete():
+            if object not in self.blobs:
+                raise http_error(404)
+            del self.blobs[object]
+        return FakeRequest(delete)
+
+
+class UploadTest(unittest.TestCase):
+
+    def setUp(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(os.urandom(10 * 1024 + 100))
+        self.addCleanup(os.remove, path)
+        self.archive = open(path, 'rb')
+        self.addCleanup(self.archive.close)
+        with open(path, 'rb') as fp:
+            self.data = fp.read()
+        self.key = 'source/%s.tar.gz' % gce._sha256(path)
+
+        self.gcs = FakeGCS(buckets=['bucket'])
+        for name, value in [('get_service', lambda *a, **kw: self.gcs),
+                            ('get_credentials', mock.Mock)]:
+            patcher = mock.patch.object(gce, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def upload(self, bucket='bucket', **kwargs):
+        return gce.upload_to_gcr('project', bucket, self.archive,
+                                 echo=lambda message: None, **kwargs)
+
+    def test_upload_in_one_piece(self):
+        self.assertEqual(self.upload(), self.key)
+        self.assertEqual(self.gcs.blobs, {self.key: self.data})
+
+    def test_creates_missing_bucket(self):
+        self.assertEqual(self.upload(bucket='other'), self.key)
+        self.assertIn('other', self.gcs.buckets_)
+
+    def test_skips_uploaded_archive(self):
+        self.gcs.blobs[self.key] = b'uploaded before'
+        self.assertEqual(self.upload(), self.key)
+        self.assertEqual(self.gcs.blobs, {self.key: b'uploaded before'})
+
+    def test_parallel_upload_composes_parts_in_order(self):
+        with mock.patch.object(gce, 'COMPOSE_LIMIT', 4):
+            self.assertEqual(self.upload(part_size=1024, concurrency=3),
+                             self.key)
+
+        # 11 parts compose in a round of 3 intermediate objects, and every
+        # temporary object is gone afterwards
+        self.assertEqual(self.gcs.blobs, {self.key: self.data})
+        self.assertEqual(len(self.gcs.composed), 4)
+        self.assertEqual(self.gcs.composed[-1][0], self.key)
+
+    def test_failed_parallel_upload_deletes_parts(self):
+        self.gcs.broken.add('%s.part-0005' % self.key)
+        self.assertRaises(HttpError, self.upload, part_size=1024,
+                          concurrency=3)
+        self.assertEqual(self.gcs.blobs, {})
+
+
+class FakeCloudBuild(object):
+    """Cloud Build service whose builds stay queued, polling them raises
+    `error`."""
+
+    def __init__(self, error):
+        self.error     = error
+        self.created   = 0
+        self.cancelled = []
+
+    def projects(self):
+        return self
+
+    def operations(self):
+        return self
+
+    def builds(self):
+        return self
+
+    def create(self, projectId, body):
+        self.created += 1
+        build = {'id': 'build-%d' % self.created, 'status': 'QUEUED'}
+        return FakeRequest(lambda: {'name': 'operations/%s' % build['id'],
+                                    'metadata': {'build': build}})
+
+    def get(self, name):
+        def get():
+            raise self.error
+        return FakeRequest(get)
+
+    def cancel(self, projectId, id, body):
+        return FakeRequest(lambda: self.cancelled.append(id))
+
+
+class RunBuildsTest(unittest.TestCase):
+
+    def run_builds(self, service):
+        with mock.patch.object(gce, 'get_service',
+                               lambda *a, **kw: service), \
+                mock.patch.object(gce.time, 'sleep'):
+            gce.run_builds('project', 'bucket', 'source/x.tar.gz',
+                           [('gcr.io/project/web', {}, ()),
+                            ('gcr.io/project/worker', {}, ())],
+                           echo=lambda message: None)
+
+    def test_interrupt_cancels_running_builds(self):
+        service = FakeCloudBuild(KeyboardInterrupt())
+        self.assertRaises(KeyboardInterrupt, self.run_builds, service)
+        self.assertEqual(service.cancelled, ['build-1', 'build-2'])
+
+    def test_error_cancels_running_builds(self):
+        service = FakeCloudBuild(http_error(500))
+        self.assertRaises(HttpError, self.run_builds, service)
+        self.assertEqual(service.cancelled, ['build-1', 'build-2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import subprocess
+import sys
+import unittest
+
+HEAVY = ['pykube', 'compose', 'googleapiclient', 'oauth2client']
+
+
+def imported_after(code):
+    """Top level packages of HEAVY that a fresh interpreter has loaded after
+    running `code`."""
+    script = "%s\nimport sys\nprint(' '.join(m for m in %r if m in sys.modules))" \
+        % (code, HEAVY)
+    output = subprocess.check_output([sys.executable, '-c', script])
+    return output.decode('utf-8').split()
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def test_package_import_is_light(self):
+        self.assertEqual(imported_after('import rz'), [])
+
+    def test_cli_import_is_light(self):
+        self.assertEqual(imported_after('import rz.cli'), [])
+
+    def test_lazy_attributes_resolve(self):
+        self.assertEqual(imported_after('import rz; rz.Client'), ['pykube'])
+
+    def test_kube_imports_on_its_own(self):
+        self.assertIn('pykube', imported_after('import rz.kube'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+import json
+import time
+import unittest
+
+from rz import kube
+
+
+def named(name, namespace=None, resource_version='1'):
+    metadata = {'name': name, 'resourceVersion': resource_version}
+    if namespace:
+        metadata['namespace'] = namespace
+    return {'metadata': metadata}
+
+
+class InformerTest(unittest.TestCase):
+
+    def informer(self, kind, *objects):
+        informer = kube.Informer(None, kind)
+        for obj in objects:
+            informer._store('ADDED', obj)
+        return informer
+
+    def test_namespaced_lookup_defaults_to_default_namespace(self):
+        informer = self.informer('Service', named('web', 'staging'))
+        self.assertIsNone(informer.get('web'))
+
+        informer._store('ADDED', named('web', 'default'))
+        self.assertEqual(informer.get('web')['metadata']['namespace'],
+                         'default')
+        self.assertEqual(informer.get('web', 'staging')['metadata']
+                         ['namespace'], 'staging')
+
+    def test_cluster_scoped_lookup_ignores_namespace(self):
+        informer = self.informer('Namespace', named('staging'))
+        self.assertEqual(informer.get('staging')['metadata']['name'],
+                         'staging')
+        self.assertEqual(informer.get('staging', 'default')['metadata']
+                         ['name'], 'staging')
+
+
+class FakeResponse(object):
+
+    def __init__(self, body=None, lines=(), status_code=200):
+        self.body, self.lines, self.status_code = body, lines, status_code
+        self.closed = False
+
+    def json(self):
+        return self.body
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeWatchAPI(object):
+    """Serves `watches` (lists of events) one per watch request, and
+    `listing` to list requests."""
+
+    def __init__(self, listing, watches):
+        self.listing, self.watches = listing, list(watches)
+        self.requests = []
+
+    def get(self, url, namespace=None, version=None, params=None, **kwargs):
+        self.requests.append(dict(params or {}))
+        if 'watch' not in (params or {}):
+            return FakeResponse(self.listing)
+        events = self.watches.pop(0) if self.watches else []
+        return FakeResponse(lines=[json.dumps(e) for e in events])
+
+    def raise_for_status(self, r):
+        pass
+
+
+class FakeDeleteAPI(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def delete(self, **kwargs):
+        return FakeResponse(status_code=self.status_code)
+
+    def raise_for_status(self, r):
+        if r.status_code >= 400:
+            raise RuntimeError(r.status_code)
+
+
+class DeploymentTest(unittest.TestCase):
+
+    def deployment(self, status_code):
+        obj = dict(named('web', 'default'), kind='Deployment')
+        return kube.Deployment(FakeDeleteAPI(status_code), obj)
+
+    def test_delete_ignores_missing_deployment(self):
+        self.deployment(404).delete(propagation='Foreground')
+
+    def test_delete_raises_other_errors(self):
+        self.assertRaises(RuntimeError, self.deployment(409).delete)
+
+
+class WatchTest(unittest.TestCase):
+
+    def test_relists_after_gone(self):
+        a, b = named('a', 'default', '10'), named('b', 'default', '11')
+        listing = {
+            'kind': 'PodList',
+            'metadata': {'resourceVersion': '50'},
+            'items': [named('a', 'default', '10'),
+                      named('c', 'default', '40')],
+        }
+        gone = {'type': 'ERROR', 'object': {'kind': 'Status', 'code': 410}}
+        later = {'type': 'MODIFIED',
+                 'object': dict(named('a', 'default', '51'), kind='Pod')}
+        api = FakeWatchAPI(listing, [[gone], [later]])
+
+        events = []
+        for event_type, obj in kube.watch(api, 'pods', resource_version='12',
+                                          items=[a, b]):
+            events.append((event_type, obj['metadata']['name']))
+            if len(events) == 3:
+                break
+
+        # b went away while the watch was gone, a didn't change
+        self.assertEqual(events, [('DELETED', 'b'), ('ADDED', 'c'),
+                                  ('MODIFIED', 'a')])
+        self.assertEqual(api.requests[0]['resourceVersion'], '12')
+        self.assertNotIn('watch', api.requests[1])
+        self.assertEqual(api.requests[2]['resourceVersion'], '50')
+
+    def test_wait_until_gone_sees_deletions_missed_during_gone(self):
+        listing = {'kind': 'PodList', 'metadata': {'resourceVersion': '5'},
+                   'items': [named('a', 'default', '3')]}
+        gone = {'type': 'ERROR', 'object': {'kind': 'Status', 'code': 410}}
+        api = FakeWatchAPI(listing, [[gone]])
+
+        # the pod is gone by the time the watch has to relist
+        def get(url, namespace=None, version=None, params=None, **kwargs):
+            response = FakeWatchAPI.get(api, url, namespace, version, params)
+            if len(api.requests) == 3:
+                response.body = dict(listing, items=[])
+            return response
+        api.get = get
+
+        self.assertTrue(kube.wait_until_gone(api, 'pods',
+                                             deadline=time.time() + 5))
+
+
+if __name__ == '__main__':
+    unittest.main()
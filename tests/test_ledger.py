@@ -0,0 +1,169 @@
+import base64
+import json
+import shutil
+import tempfile
+import unittest
+
+import pykube
+
+from test_apply import response
+from rz import apply, ledger
+
+
+def objects(replicas=1):
+    return [
+        {'kind': 'Service', 'apiVersion': 'v1',
+         'metadata': {'name': 'web', 'namespace': 'default'},
+         'spec': {'ports': [{'port': 80}]}},
+        {'kind': 'Deployment', 'apiVersion': 'apps/v1',
+         'metadata': {'name': 'web', 'namespace': 'default',
+                      'annotations': {apply.RZD_VERSION_KEY: '3',
+                                      apply.RZD_HASH_KEY: 'abc'}},
+         'spec': {'replicas': replicas}},
+    ]
+
+
+class FakeSecretsAPI(object):
+    """Keeps secrets in memory, answering lists with metadata only when the
+    client asks for it."""
+
+    url = 'https://kube'
+
+    def __init__(self):
+        self.secrets  = {}
+        self.requests = []
+
+    def get(self, url, namespace=None, params=None, headers=None):
+        self.requests.append(('GET', url))
+        if url == 'secrets':
+            items = sorted(self.secrets.values(),
+                           key=lambda s: s['metadata']['name'])
+            if 'PartialObjectMetadataList' in (headers or {}).get('Accept',
+                                                                  ''):
+                items = [{'metadata': s['metadata']} for s in items]
+            return response(200, {'kind': 'SecretList', 'items': items})
+
+        name = url.split('/', 1)[1]
+        if name not in self.secrets:
+            return response(404, {'kind': 'Status', 'code': 404,
+                                  'message': 'not found'})
+        return response(200, self.secrets[name])
+
+    def post(self, url, namespace=None, data=None):
+        self.requests.append(('POST', url))
+        secret = json.loads(data)
+        self.secrets[secret['metadata']['name']] = secret
+        return response(201, secret)
+
+    def patch(self, url, namespace=None, data=None, headers=None):
+        self.requests.append(('PATCH', url))
+        secret = self.secrets[url.split('/', 1)[1]]
+        secret['metadata']['annotations'].update(
+            json.loads(data)['metadata']['annotations'])
+        return response(200, secret)
+
+    def delete(self, url, namespace=None):
+        self.requests.append(('DELETE', url))
+        if self.secrets.pop(url.split('/', 1)[1], None) is None:
+            return response(404, {'kind': 'Status', 'code': 404,
+                                  'message': 'not found'})
+        return response(200, {})
+
+    def raise_for_status(self, r):
+        raise_for_status = pykube.HTTPClient.raise_for_status
+        getattr(raise_for_status, '__func__', raise_for_status)(self, r)
+
+
+class EncodingTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        self.assertEqual(ledger.decode(ledger.encode(objects())), objects())
+
+    def test_encoding_is_reproducible(self):
+        reordered = [dict(reversed(list(o.items()))) for o in objects()]
+        self.assertEqual(ledger.encode(objects()), ledger.encode(reordered))
+
+    def test_diff_leaves_out_rzd_annotations(self):
+        old, new = objects(), objects(replicas=3)
+        new[1]['metadata']['annotations'][apply.RZD_VERSION_KEY] = '4'
+
+        lines = ledger.diff(old, new, 'r3', 'r4')
+        self.assertEqual(lines[:2], ['--- r3/Deployment/default/web',
+                                     '+++ r4/Deployment/default/web'])
+        changed = [line for line in lines[2:]
+                   if line[:1] in '+-' and not line.startswith('@@')]
+        self.assertEqual(changed, ['-  replicas: 1', '+  replicas: 3'])
+        self.assertEqual(ledger.diff(objects(), objects()), [])
+
+
+class LedgerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = FakeSecretsAPI()
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+    def ledger(self, **kwargs):
+        kwargs.setdefault('cache_dir', self.cache_dir)
+        return ledger.Ledger(self.api, 'default', 'app', **kwargs)
+
+    def test_lists_metadata_once_and_loads_lazily(self):
+        self.ledger().record(1, objects())
+
+        # another machine, with nothing cached
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        history = self.ledger(cache_dir=cache_dir)
+        del self.api.requests[:]
+
+        self.assertEqual([r.number for r in history.revisions()], [1])
+        self.assertEqual(history.latest(), 1)
+        self.assertEqual(self.api.requests, [('GET', 'secrets')])
+
+        # fetched once, then read from the cache
+        self.assertEqual(history.load(1), objects())
+        self.assertEqual(history.load(1), objects())
+        self.assertEqual(self.api.requests[1:],
+                         [('GET', 'secrets/rzd.app.v1')])
+        self.assertRaises(KeyError, history.load, 2)
+
+    def test_record_and_status_update_the_listing(self):
+        history = self.ledger()
+        self.assertEqual(history.revisions(), [])
+        history.record(1, objects())
+        history.set_status(1, ledger.STATUS_DEPLOYED)
+
+        revisions = history.revisions()
+        self.assertEqual([(r.number, r.status, r.objects) for r in revisions],
+                         [(1, ledger.STATUS_DEPLOYED, 2)])
+        self.assertEqual(
+            [(r.number, r.status) for r in self.ledger().revisions()],
+            [(1, ledger.STATUS_DEPLOYED)])
+        self.assertEqual(self.api.requests.count(('GET', 'secrets')), 2)
+
+    def test_prune_keeps_newest_and_last_deployed(self):
+        history = self.ledger(keep=2)
+        for number in range(1, 6):
+            history.record(number, objects(number))
+        history.set_status(2, ledger.STATUS_DEPLOYED)
+
+        self.assertEqual(history.prune(), [1, 3])
+        self.assertEqual(sorted(self.api.secrets),
+                         ['rzd.app.v2', 'rzd.app.v4', 'rzd.app.v5'])
+        self.assertEqual([r.number for r in history.revisions()], [2, 4, 5])
+        self.assertEqual(
+            [r.number for r in self.ledger(keep=0).revisions()], [2, 4, 5])
+        self.assertEqual(self.ledger(keep=0).prune(), [])
+
+    def test_secret_payload(self):
+        self.ledger().record(1, objects())
+        secret = self.api.secrets['rzd.app.v1']
+        self.assertEqual(secret['type'], ledger.SECRET_TYPE)
+        self.assertEqual(secret['metadata']['labels'][ledger.REVISION_LABEL],
+                         '1')
+        self.assertEqual(ledger.decode(base64.b64decode(
+            secret['data'][ledger.DATA_KEY])), objects())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from rz import manifest
+
+
+def objects():
+    return [
+        {'kind': 'Namespace', 'apiVersion': 'v1',
+         'metadata': {'name': 'staging'}},
+        {'kind': 'Deployment', 'apiVersion': 'apps/v1',
+         'metadata': {'name': 'web', 'namespace': 'staging',
+                      'annotations': {'description': u'caf\xe9'}},
+         'spec': {'replicas': 2, 'paused': False,
+                  'template': {'spec': {'containers': [
+                      {'name': 'web', 'image': 'web:latest',
+                       'args': ['--port', '80']}]}}}},
+    ]
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def round_trip(self, name):
+        path = os.path.join(self.dir, name)
+        manifest.dump(iter(objects()), path)
+        return path, list(manifest.load(path))
+
+    def test_yaml_round_trip(self):
+        path, loaded = self.round_trip('deploy.yml')
+        self.assertEqual(loaded, objects())
+        with open(path) as fp:
+            self.assertEqual(fp.read().count('---\n'), 1)
+
+    def test_jsonl_round_trip(self):
+        path, loaded = self.round_trip('deploy.jsonl')
+        self.assertEqual(loaded, objects())
+        with open(path) as fp:
+            self.assertEqual(len(fp.read().splitlines()), 2)
+
+    def test_load_is_lazy_and_skips_empty_documents(self):
+        path = os.path.join(self.dir, 'deploy.yaml')
+        with open(path, 'w') as fp:
+            fp.write('---\nkind: Service\n---\n---\nkind: Deployment\n')
+
+        loaded = manifest.load(path)
+        self.assertIsInstance(loaded, types.GeneratorType)
+        self.assertEqual([o['kind'] for o in loaded],
+                         ['Service', 'Deployment'])
+
+    def test_is_jsonl(self):
+        self.assertTrue(manifest.is_jsonl('deploy.jsonl'))
+        self.assertTrue(manifest.is_jsonl('out/deploy.ndjson'))
+        self.assertFalse(manifest.is_jsonl('deploy.yml'))
+        self.assertFalse(manifest.is_jsonl('deploy.json'))
+        self.assertFalse(manifest.is_jsonl('deploy.jsonl.yml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
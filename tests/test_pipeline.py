@@ -0,0 +1,103 @@
+import threading
+import unittest
+
+from rz import pipeline
+
+
+class Abort(BaseException):
+    pass
+
+
+def run(items, stages, **kwargs):
+    """pipeline.run, failing the test instead of hanging when an item is
+    never accounted for."""
+    out = []
+    thread = threading.Thread(
+        target=lambda: out.append(pipeline.run(items, stages, **kwargs)))
+    thread.daemon = True
+    thread.start()
+    thread.join(10)
+    if not out:
+        raise AssertionError("pipeline.run didn't return")
+    return out[0]
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_items_move_on_without_waiting_for_others(self):
+        release, order = threading.Event(), []
+
+        def build(item):
+            if item == 'slow':
+                release.wait(5)
+            return item
+
+        def deploy(item):
+            order.append(item)
+            if item == 'fast':
+                release.set()
+            return item
+
+        stages = [pipeline.Stage('build', build, 2),
+                  pipeline.Stage('deploy', deploy, 1)]
+        results = run(['slow', 'fast'], stages)
+
+        self.assertEqual(order, ['fast', 'slow'])
+        self.assertEqual([r.name for r in results], ['slow', 'fast'])
+        self.assertTrue(all(r.ok for r in results))
+        self.assertEqual(results[0].statuses, {'build': pipeline.STAGE_OK,
+                                               'deploy': pipeline.STAGE_OK})
+
+    def test_values_pass_through_stages(self):
+        seen = []
+        stages = [pipeline.Stage('double', lambda x: x * 2, 4),
+                  pipeline.Stage('record', seen.append, 1)]
+        run([1, 2, 3], stages, names=['a', 'b', 'c'])
+        self.assertEqual(sorted(seen), [2, 4, 6])
+
+    def test_failure_cancels_remaining_items(self):
+        def build(item):
+            if item == 1:
+                raise RuntimeError("build failed")
+            return item
+
+        stages = [pipeline.Stage('build', build, 1),
+                  pipeline.Stage('deploy', lambda item: item, 1)]
+        results = run([1, 2], stages)
+
+        self.assertEqual(results[0].statuses,
+                         {'build': pipeline.STAGE_FAILED})
+        self.assertEqual(str(results[0].error), "build failed")
+        self.assertEqual(results[1].statuses,
+                         {'build': pipeline.STAGE_CANCELLED})
+        self.assertFalse(any(r.ok for r in results))
+
+    def test_keep_going_runs_remaining_items(self):
+        def build(item):
+            if item == 1:
+                raise RuntimeError("build failed")
+            return item
+
+        stages = [pipeline.Stage('build', build, 1),
+                  pipeline.Stage('deploy', lambda item: item, 1)]
+        results = run([1, 2], stages, keep_going=True)
+
+        self.assertFalse(results[0].ok)
+        self.assertTrue(results[1].ok)
+        self.assertEqual(results[1].statuses['deploy'], pipeline.STAGE_OK)
+
+    def test_stage_raising_base_exception_still_finishes(self):
+        def deploy(item):
+            raise Abort()
+
+        stages = [pipeline.Stage('build', lambda item: item, 1),
+                  pipeline.Stage('deploy', deploy, 1)]
+        results = run([1], stages)
+
+        self.assertEqual(results[0].statuses['deploy'],
+                         pipeline.STAGE_FAILED)
+        self.assertIsInstance(results[0].error, Abort)
+
+
+if __name__ == '__main__':
+    unittest.main()
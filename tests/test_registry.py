@@ -0,0 +1,73 @@
+import json
+import unittest
+
+import httpretty
+
+from rz.registry import Registry
+
+DIGEST = 'sha256:' + 'a' * 64
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        httpretty.enable(allow_net_connect=False)
+        self.addCleanup(httpretty.reset)
+        self.addCleanup(httpretty.disable)
+
+    def serve_manifest(self, exists=True):
+        """A registry answering HEAD manifest requests only with the token
+        its auth server hands out."""
+
+        def manifest(request, uri, headers):
+            if request.headers.get('Authorization') != 'Bearer t0k3n':
+                headers['WWW-Authenticate'] = (
+                    'Bearer realm="https://auth.registry.io/token",'
+                    'service="registry.io"')
+                return 401, headers, ''
+            if not exists:
+                return 404, headers, ''
+            headers['Docker-Content-Digest'] = DIGEST
+            return 200, headers, ''
+
+        httpretty.register_uri(httpretty.HEAD,
+                               'https://registry.io/v2/app/web/manifests/1',
+                               body=manifest)
+        httpretty.register_uri(httpretty.GET,
+                               'https://auth.registry.io/token',
+                               body=json.dumps({'token': 't0k3n'}))
+
+    def token_requests(self):
+        return [r for r in httpretty.latest_requests()
+                if r.headers.get('Host') == 'auth.registry.io']
+
+    def test_manifest_digest_with_bearer_token(self):
+        self.serve_manifest()
+        registry = Registry('registry.io', 'user', 'secret')
+
+        self.assertEqual(registry.manifest_digest('app/web', '1'), DIGEST)
+        self.assertTrue(registry.has_image('app/web', '1'))
+
+        # the token is asked for once, with the repository's pull scope
+        tokens = self.token_requests()
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(tokens[0].querystring['scope'],
+                         ['repository:app/web:pull'])
+        self.assertEqual(tokens[0].querystring['service'], ['registry.io'])
+        self.assertTrue(tokens[0].headers['Authorization'].startswith('Basic'))
+
+    def test_missing_manifest(self):
+        self.serve_manifest(exists=False)
+        registry = Registry('https://registry.io/')
+
+        self.assertIsNone(registry.manifest_digest('app/web', '1'))
+        self.assertFalse(registry.has_image('app/web', '1'))
+
+    def test_server_url_is_normalised(self):
+        registry = Registry('https://registry.io/')
+        self.assertEqual(registry.server, 'registry.io')
+        self.assertEqual(registry.url, 'https://registry.io')
+
+
+if __name__ == '__main__':
+    unittest.main()